@@ -0,0 +1,418 @@
+"""
+LangChain token与费用统计模块
+
+这个模块在模型调用前后做token统计：
+- 发送前用本地分词器(tiktoken，离线不可用时退化为按字符估算)计算提示的token数
+- 按单次请求和会话的输入/输出预算裁剪对话历史或拒绝请求
+- 记录提供商返回的实际用量，按示例、模型和会话汇总token数和费用
+"""
+
+import os
+import json
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.messages import BaseMessage, trim_messages
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+from .models import WrappedChatModel
+
+# 当前调用所属的示例和会话，由run_example和服务模式设置
+_current_example: ContextVar[str] = ContextVar("usage_example", default="-")
+_current_session: ContextVar[str] = ContextVar("usage_session", default="default")
+
+# 每百万token的价格(美元)：(输入, 输出)，可以用MODEL_PRICES覆盖，本地Ollama模型不计费
+DEFAULT_PRICES: Dict[str, Tuple[float, float]] = {
+    "gpt-3.5-turbo": (0.5, 1.5),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4": (30.0, 60.0),
+    "deepseek-chat": (0.27, 1.1),
+    "deepseek-coder": (0.27, 1.1)
+}
+
+# tiktoken加载失败或超时后不再尝试，之后的调用直接使用估算
+_encoding_unavailable = False
+
+class TokenBudgetExceeded(ValueError):
+    """请求超出了token预算"""
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: Optional[str]):
+    """
+    获取模型对应的tiktoken编码，未知模型使用cl100k_base，tiktoken不可用时返回None
+
+    第一次使用时tiktoken会下载编码文件，离线环境下这个请求可能长时间阻塞，
+    所以在后台线程中加载，超过TIKTOKEN_LOAD_TIMEOUT秒(默认3)时放弃。
+    """
+    global _encoding_unavailable
+    if _encoding_unavailable:
+        return None
+    try:
+        import tiktoken
+    except ImportError:
+        _encoding_unavailable = True
+        return None
+
+    result: Dict[str, Any] = {}
+
+    def load():
+        try:
+            try:
+                result["encoding"] = tiktoken.encoding_for_model(model or "")
+            except KeyError:
+                result["encoding"] = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            # 离线环境下无法下载编码文件
+            pass
+
+    thread = threading.Thread(target=load, name="tiktoken-load", daemon=True)
+    thread.start()
+    thread.join(float(os.getenv("TIKTOKEN_LOAD_TIMEOUT", 3)))
+    if "encoding" not in result:
+        _encoding_unavailable = True
+        return None
+    return result["encoding"]
+
+def count_tokens(text: str, model: Optional[str] = None) -> int:
+    """
+    计算文本的token数
+
+    Args:
+        text: 文本
+        model: 模型名称，用于选择分词器
+
+    Returns:
+        int: token数
+    """
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    # 粗略估算：非ASCII字符按1个token，ASCII字符按4个字符1个token
+    return int(sum(1.0 if ord(char) > 127 else 0.25 for char in text) + 0.5)
+
+def truncate_tokens(text: str, max_tokens: int, model: Optional[str] = None) -> str:
+    """
+    把文本截断到不超过max_tokens个token
+
+    Args:
+        text: 文本
+        max_tokens: 最多保留的token数
+        model: 模型名称，用于选择分词器
+
+    Returns:
+        str: 截断后的文本
+    """
+    if max_tokens <= 0:
+        return ""
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    # 与count_tokens相同的估算，保留累计开销不超过预算的前缀
+    used = 0.0
+    for end, char in enumerate(text):
+        used += 1.0 if ord(char) > 127 else 0.25
+        if used > max_tokens:
+            return text[:end]
+    return text
+
+def count_message_tokens(messages: List[BaseMessage], model: Optional[str] = None) -> int:
+    """
+    计算消息列表的token数，包括每条消息的角色和格式开销以及工具调用参数
+
+    Args:
+        messages: 消息列表
+        model: 模型名称
+
+    Returns:
+        int: token数
+    """
+    total = 3
+    for message in messages:
+        text = message.content if isinstance(message.content, str) else json.dumps(message.content, ensure_ascii=False)
+        total += 4 + count_tokens(text, model)
+        tool_calls = getattr(message, "tool_calls", None)
+        if tool_calls:
+            total += count_tokens(json.dumps(tool_calls, ensure_ascii=False, default=str), model)
+    return total
+
+def _parse_prices(spec: Optional[str]) -> Dict[str, Tuple[float, float]]:
+    """解析"模型=输入价格/输出价格;..."格式的价格配置"""
+    prices = dict(DEFAULT_PRICES)
+    for item in (spec or "").split(";"):
+        if "=" not in item:
+            continue
+        model, value = item.split("=", 1)
+        input_price, output_price = value.split("/", 1)
+        prices[model.strip()] = (float(input_price), float(output_price))
+    return prices
+
+def estimate_cost(model_type: str, model: str, input_tokens: int, output_tokens: int) -> float:
+    """按每百万token的价格估算费用(美元)，未知模型按0计算"""
+    if model_type == "ollama":
+        return 0.0
+    prices = _parse_prices(os.getenv("MODEL_PRICES"))
+    # 取最长的前缀匹配，例如"gpt-4-turbo-2024-04-09"匹配"gpt-4-turbo"
+    matches = [name for name in prices if model.startswith(name)]
+    if not matches:
+        return 0.0
+    input_price, output_price = prices[max(matches, key=len)]
+    return (input_tokens * input_price + output_tokens * output_price) / 1_000_000
+
+class TokenBudget:
+    """
+    token预算
+
+    为None的项不限制。action为"trim"时超出输入预算会从最早的对话历史开始裁剪，
+    裁剪后仍超出或action为"refuse"时拒绝请求。
+    """
+
+    def __init__(
+        self,
+        request_input: Optional[int] = None,
+        request_output: Optional[int] = None,
+        session_input: Optional[int] = None,
+        session_output: Optional[int] = None,
+        action: str = "trim"
+    ):
+        if action not in ("trim", "refuse"):
+            raise ValueError(f"未知的预算处理方式: {action}，可选: trim, refuse")
+        self.request_input = request_input
+        self.request_output = request_output
+        self.session_input = session_input
+        self.session_output = session_output
+        self.action = action
+
+def _env_int(name: str) -> Optional[int]:
+    value = os.getenv(name)
+    return int(value) if value else None
+
+def get_token_budget() -> TokenBudget:
+    """从环境变量读取token预算"""
+    return TokenBudget(
+        request_input=_env_int("TOKEN_BUDGET_REQUEST_INPUT"),
+        request_output=_env_int("TOKEN_BUDGET_REQUEST_OUTPUT"),
+        session_input=_env_int("TOKEN_BUDGET_SESSION_INPUT"),
+        session_output=_env_int("TOKEN_BUDGET_SESSION_OUTPUT"),
+        action=os.getenv("TOKEN_BUDGET_ACTION", "trim")
+    )
+
+def _empty_totals() -> Dict[str, Any]:
+    return {
+        "requests": 0,
+        "input_tokens": 0,
+        "output_tokens": 0,
+        "cost": 0.0,
+        "estimated": 0,
+        "trimmed": 0,
+        "refused": 0
+    }
+
+class UsageLedger:
+    """按示例、模型和会话汇总的用量账本"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals: Dict[str, Dict[str, Dict[str, Any]]] = {"example": {}, "model": {}, "session": {}}
+
+    def _buckets(self, example: str, model: str, session: str) -> List[Dict[str, Any]]:
+        return [
+            self.totals[dimension].setdefault(key, _empty_totals())
+            for dimension, key in (("example", example), ("model", model), ("session", session))
+        ]
+
+    def record(
+        self,
+        example: str,
+        model: str,
+        session: str,
+        input_tokens: int,
+        output_tokens: int,
+        cost: float,
+        estimated: bool
+    ):
+        with self._lock:
+            for bucket in self._buckets(example, model, session):
+                bucket["requests"] += 1
+                bucket["input_tokens"] += input_tokens
+                bucket["output_tokens"] += output_tokens
+                bucket["cost"] += cost
+                bucket["estimated"] += int(estimated)
+
+    def record_event(self, example: str, model: str, session: str, event: str):
+        """记录一次裁剪(trimmed)或拒绝(refused)"""
+        with self._lock:
+            for bucket in self._buckets(example, model, session):
+                bucket[event] += 1
+
+    def session_usage(self, session: str) -> Tuple[int, int]:
+        """返回会话已使用的(输入, 输出)token数"""
+        with self._lock:
+            bucket = self.totals["session"].get(session)
+            return (bucket["input_tokens"], bucket["output_tokens"]) if bucket else (0, 0)
+
+    def report(self) -> Dict[str, Dict[str, Dict[str, Any]]]:
+        with self._lock:
+            return {
+                dimension: {key: dict(values) for key, values in buckets.items()}
+                for dimension, buckets in self.totals.items()
+            }
+
+_ledger = UsageLedger()
+
+def get_usage_report() -> Dict[str, Dict[str, Dict[str, Any]]]:
+    """返回按示例(example)、模型(model)和会话(session)汇总的用量"""
+    return _ledger.report()
+
+@contextmanager
+def usage_scope(example: Optional[str] = None, session: Optional[str] = None):
+    """
+    设置当前调用所属的示例和会话
+
+    Args:
+        example: 示例名称，例如"example.1"
+        session: 会话ID
+    """
+    tokens = []
+    if example is not None:
+        tokens.append((_current_example, _current_example.set(example)))
+    if session is not None:
+        tokens.append((_current_session, _current_session.set(session)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+def _actual_usage(message: BaseMessage, generation_info: Optional[Dict[str, Any]]) -> Optional[Tuple[int, int]]:
+    """从响应中读取实际的输入/输出token数，兼容usage_metadata和Ollama的字段"""
+    usage = getattr(message, "usage_metadata", None)
+    if usage:
+        return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    info = generation_info or {}
+    if info.get("prompt_eval_count") is not None or info.get("eval_count") is not None:
+        return info.get("prompt_eval_count") or 0, info.get("eval_count") or 0
+    return None
+
+class AccountedChatModel(WrappedChatModel):
+    """
+    带token统计和预算控制的聊天模型
+
+    发送前按预算裁剪或拒绝请求，并把单次请求的输出上限传给提供商
+    (OpenAI兼容接口用max_tokens，Ollama用num_predict)；收到响应后记录实际用量。
+    """
+
+    model_type: str
+    model_name: str
+    budget: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return f"accounted-{self.inner._llm_type}"
+
+    def _prepare(
+        self,
+        messages: List[BaseMessage],
+        kwargs: Dict[str, Any]
+    ) -> Tuple[List[BaseMessage], Dict[str, Any], int]:
+        """按预算处理请求，返回(消息, 调用参数, 输入token数)"""
+        example, session = _current_example.get(), _current_session.get()
+        used_input, used_output = _ledger.session_usage(session)
+        budget = self.budget
+
+        limits = []
+        if budget.request_input is not None:
+            limits.append(budget.request_input)
+        if budget.session_input is not None:
+            limits.append(budget.session_input - used_input)
+        input_tokens = count_message_tokens(messages, self.model_name)
+
+        was_trimmed = False
+        if limits and input_tokens > min(limits):
+            allowed = min(limits)
+            trimmed: List[BaseMessage] = []
+            if budget.action == "trim" and allowed > 0:
+                trimmed = trim_messages(
+                    messages,
+                    max_tokens=allowed,
+                    token_counter=lambda items: count_message_tokens(items, self.model_name),
+                    strategy="last",
+                    include_system=True,
+                    start_on="human",
+                    allow_partial=False
+                )
+            # 最新的一条消息也被裁掉时，说明单条消息就超出了预算
+            if not trimmed or trimmed[-1] is not messages[-1]:
+                _ledger.record_event(example, self.model_name, session, "refused")
+                raise TokenBudgetExceeded(f"请求需要{input_tokens}个输入token，超出了预算({allowed})")
+            was_trimmed = True
+            messages = trimmed
+            input_tokens = count_message_tokens(messages, self.model_name)
+
+        caps = []
+        if budget.request_output is not None:
+            caps.append(budget.request_output)
+        if budget.session_output is not None:
+            remaining = budget.session_output - used_output
+            if remaining <= 0:
+                _ledger.record_event(example, self.model_name, session, "refused")
+                raise TokenBudgetExceeded(f"会话'{session}'的输出token预算({budget.session_output})已用完")
+            caps.append(remaining)
+        # 路由模式下后端类型不确定，只能在会话预算用完时拒绝
+        if caps and self.model_type in ("openai", "deepseek", "ollama"):
+            key = "num_predict" if self.model_type == "ollama" else "max_tokens"
+            kwargs = {**kwargs, key: min(caps + ([kwargs[key]] if kwargs.get(key) else []))}
+        # 所有预算检查都通过后才记为裁剪，被拒绝的请求只计入refused
+        if was_trimmed:
+            _ledger.record_event(example, self.model_name, session, "trimmed")
+        return messages, kwargs, input_tokens
+
+    def _record(self, message: BaseMessage, generation_info: Optional[Dict[str, Any]], input_tokens: int):
+        usage = _actual_usage(message, generation_info)
+        estimated = usage is None
+        if estimated:
+            text = message.content if isinstance(message.content, str) else str(message.content)
+            usage = (input_tokens, count_tokens(text, self.model_name))
+        metadata = getattr(message, "response_metadata", None) or {}
+        model = metadata.get("model_name") or metadata.get("model") or self.model_name
+        _ledger.record(
+            _current_example.get(),
+            model,
+            _current_session.get(),
+            usage[0],
+            usage[1],
+            estimate_cost(self.model_type, model, usage[0], usage[1]),
+            estimated
+        )
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        messages, kwargs, input_tokens = self._prepare(messages, kwargs)
+        result = self.inner._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        for generation in result.generations:
+            self._record(generation.message, generation.generation_info, input_tokens)
+        return result
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        messages, kwargs, input_tokens = self._prepare(messages, kwargs)
+        merged: Optional[ChatGenerationChunk] = None
+        for chunk in self.inner._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            merged = chunk if merged is None else merged + chunk
+            yield chunk
+        if merged is not None:
+            self._record(merged.message, merged.generation_info, input_tokens)
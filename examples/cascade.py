@@ -0,0 +1,424 @@
+"""
+LangChain级联路由模块
+
+这个模块提供了一个级联聊天模型：先用最快/最便宜的模型回答，只有当评审器(judge)拒绝
+这个回答，或者这一层调用失败(服务不可用、超时、被限流)时才升级到更大的模型。内置的评审器有：
+- ParserJudge: 用输出解析器(例如JsonOutputParser)解析并校验输出模式
+- HeuristicJudge: 按回答长度、是否被截断、是否含有"不知道"之类的回避语句和平均logprob判断
+- SelfCheckJudge: 让模型自己检查回答是否正确完整
+
+每条路由都会记录升级率、各层级的回答占比和相对于直接使用最大模型节省的时间。
+"""
+
+import os
+import re
+import json
+import time
+import threading
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from langchain_core.callbacks import CallbackManager, CallbackManagerForLLMRun
+from langchain_core.exceptions import OutputParserException
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.output_parsers import BaseOutputParser, JsonOutputParser
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from .models import WrappedChatModel
+
+# 全局路由统计，相同路由名称的级联模型共享统计信息
+_routes: Dict[str, "RouteStats"] = {}
+_routes_lock = threading.Lock()
+# 级联模型缓存，相同配置的调用共享层级模型和评审器
+_cascades: Dict[Tuple[str, str, str], BaseChatModel] = {}
+_cascades_lock = threading.Lock()
+
+_THINK_PATTERN = re.compile(r"<think>.*?</think>", re.DOTALL)
+# 小模型没有把握时常见的回避语句
+_UNCERTAIN_PHRASES = (
+    "我不知道", "我不确定", "无法回答", "无法确定", "没有足够的信息",
+    "i don't know", "i do not know", "i'm not sure", "i am not sure", "cannot answer"
+)
+
+def _answer_text(message: BaseMessage) -> str:
+    """取回答文本，去掉推理模型(如deepseek-r1)输出的<think>块"""
+    content = message.content if isinstance(message.content, str) else str(message.content)
+    return _THINK_PATTERN.sub("", content).strip()
+
+class ParserJudge:
+    """
+    解析校验评审器
+
+    输出解析失败，或解析结果不符合解析器的pydantic_object模式时拒绝回答。
+    """
+
+    name = "parser"
+
+    def __init__(self, parser: BaseOutputParser):
+        self.parser = parser
+
+    def __call__(self, messages: List[BaseMessage], answer: AIMessage) -> Optional[str]:
+        try:
+            parsed = self.parser.invoke(answer)
+        except OutputParserException as e:
+            return f"解析失败: {str(e)[:200]}"
+        schema = getattr(self.parser, "pydantic_object", None)
+        if schema is not None:
+            validate = getattr(schema, "model_validate", None) or schema.parse_obj
+            try:
+                validate(parsed)
+            except Exception as e:
+                return f"不符合输出模式: {str(e)[:200]}"
+        return None
+
+class HeuristicJudge:
+    """
+    启发式评审器
+
+    回答过短、过长、因为达到输出上限被截断，或者含有"我不知道"之类的回避语句时拒绝；
+    提供商返回了logprobs(OpenAI/DeepSeek)时，平均logprob低于阈值也拒绝。
+    """
+
+    name = "heuristic"
+
+    def __init__(
+        self,
+        min_length: int = 10,
+        max_length: Optional[int] = None,
+        min_logprob: Optional[float] = None,
+        uncertain_phrases: Sequence[str] = _UNCERTAIN_PHRASES
+    ):
+        self.min_length = min_length
+        self.max_length = max_length
+        self.min_logprob = min_logprob
+        self.uncertain_phrases = tuple(phrase.lower() for phrase in uncertain_phrases)
+        # 需要logprobs时，级联模型会在调用支持的层级时带上logprobs=True
+        self.needs_logprobs = min_logprob is not None
+
+    def __call__(self, messages: List[BaseMessage], answer: AIMessage) -> Optional[str]:
+        text = _answer_text(answer)
+        if len(text) < self.min_length:
+            return f"回答过短({len(text)}字)"
+        if self.max_length is not None and len(text) > self.max_length:
+            return f"回答过长({len(text)}字)"
+        metadata = answer.response_metadata
+        if (metadata.get("finish_reason") or metadata.get("done_reason")) == "length":
+            return "回答达到输出上限被截断"
+        lowered = text.lower()
+        for phrase in self.uncertain_phrases:
+            if phrase in lowered:
+                return f"回答没有把握({phrase})"
+        if self.min_logprob is not None:
+            tokens = (answer.response_metadata.get("logprobs") or {}).get("content") or []
+            if tokens:
+                mean = sum(token["logprob"] for token in tokens) / len(tokens)
+                if mean < self.min_logprob:
+                    return f"平均logprob过低({mean:.2f})"
+        return None
+
+class SelfCheckJudge:
+    """
+    自检评审器
+
+    用一个模型(通常就是第一层的小模型)判断回答是否正确完整，回答"否"时拒绝。
+    这个模型应当通过get_chat_model创建，自检调用的token用量和费用才会计入统计。
+    """
+
+    name = "self_check"
+
+    def __init__(self, model: BaseChatModel):
+        self.model = model
+
+    def __call__(self, messages: List[BaseMessage], answer: AIMessage) -> Optional[str]:
+        from .prompts import render_messages
+
+        questions = [m for m in messages if isinstance(m, HumanMessage)]
+        question = questions[-1].content if questions else ""
+        verdict = _answer_text(self.model.invoke(
+            render_messages("cascade.self_check", question=question, answer=_answer_text(answer))
+        ))
+        if verdict.lower().startswith(("否", "不", "no")):
+            return f"自检未通过: {verdict[:50]}"
+        return None
+
+class RouteStats:
+    """
+    单条路由的级联统计
+
+    节省的时间按"最后一层的EWMA延迟 - 本次请求的实际总耗时"估算，
+    在最后一层至少被调用过一次之后开始累计(升级到最后一层的请求会记为负的节省)。
+    """
+
+    def __init__(self, tiers: List[str], alpha: float = 0.2):
+        self.tiers = tiers
+        self.alpha = alpha
+        self.requests = 0
+        self.escalated = 0
+        self.failures = 0
+        self.answered_by: Counter = Counter()
+        self.rejections: Counter = Counter()
+        self.tier_latency: Dict[str, float] = {}
+        self.total_latency = 0.0
+        self.saved = 0.0
+        self.saved_requests = 0
+        self._lock = threading.Lock()
+
+    def record(self, attempts: List[Tuple[str, float, Optional[str]]], failed: bool = False):
+        """
+        记录一次请求
+
+        Args:
+            attempts: 每一层的(层级名称, 耗时, 拒绝原因)，最后一项是最终采用的回答
+            failed: 最后一层也调用失败，这次请求没有回答
+        """
+        with self._lock:
+            self.requests += 1
+            if len(attempts) > 1:
+                self.escalated += 1
+            for name, seconds, reason in attempts:
+                previous = self.tier_latency.get(name)
+                self.tier_latency[name] = seconds if previous is None else (
+                    self.alpha * seconds + (1 - self.alpha) * previous
+                )
+                if reason is not None:
+                    self.rejections[name] += 1
+
+            elapsed = sum(seconds for _, seconds, _ in attempts)
+            self.total_latency += elapsed
+            if failed:
+                # 没有回答的请求不计入各层级的回答占比和节省的时间
+                self.failures += 1
+                return
+            self.answered_by[attempts[-1][0]] += 1
+            baseline = self.tier_latency.get(self.tiers[-1])
+            if baseline is not None:
+                self.saved += baseline - elapsed
+                self.saved_requests += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "escalation_rate": self.escalated / self.requests if self.requests else 0.0,
+                "failures": self.failures,
+                "answered_by": dict(self.answered_by),
+                "rejections": dict(self.rejections),
+                "avg_latency": self.total_latency / self.requests if self.requests else 0.0,
+                "tier_latency": dict(self.tier_latency),
+                "saved_seconds": self.saved,
+                "avg_saved_seconds": self.saved / self.saved_requests if self.saved_requests else None
+            }
+
+def get_route_stats(route: str, tiers: List[str]) -> RouteStats:
+    """获取(或创建)指定路由的统计对象"""
+    with _routes_lock:
+        if route not in _routes:
+            _routes[route] = RouteStats(tiers)
+        return _routes[route]
+
+def get_cascade_stats() -> Dict[str, Dict[str, Any]]:
+    """返回所有级联路由的统计信息"""
+    with _routes_lock:
+        return {route: stats.stats() for route, stats in _routes.items()}
+
+def _child_callbacks(run_manager: CallbackManagerForLLMRun) -> CallbackManager:
+    """让各层级的模型调用作为级联调用的子运行，埋点时能看到每一层的耗时"""
+    return CallbackManager(
+        handlers=run_manager.inheritable_handlers,
+        inheritable_handlers=run_manager.inheritable_handlers,
+        parent_run_id=run_manager.run_id,
+        tags=run_manager.inheritable_tags,
+        inheritable_tags=run_manager.inheritable_tags,
+        metadata=run_manager.inheritable_metadata,
+        inheritable_metadata=run_manager.inheritable_metadata
+    )
+
+class CascadeChatModel(WrappedChatModel):
+    """
+    级联聊天模型
+
+    按顺序调用各层级，直到某一层的回答通过所有评审器，最后一层的回答总是被采用。
+    除最后一层外，某一层调用出错时记为拒绝原因并升级到下一层。
+    评审器需要完整的回答，所以流式调用会等整个回答生成后一次性输出。
+    inner是第一层的模型，只用于把工具转换成提供商格式。
+    """
+
+    tiers: List[BaseChatModel]
+    tier_names: List[str]
+    tier_kwargs: List[Dict[str, Any]]
+    judges: List[Any]
+    stats: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return "cascade"
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        config = {"callbacks": _child_callbacks(run_manager)} if run_manager else None
+        attempts: List[Tuple[str, float, Optional[str]]] = []
+        last = len(self.tiers) - 1
+        for index, (name, model) in enumerate(zip(self.tier_names, self.tiers)):
+            start = time.perf_counter()
+            try:
+                answer = model.invoke(messages, config, stop=stop, **{**self.tier_kwargs[index], **kwargs})
+            except Exception as e:
+                attempts.append((name, time.perf_counter() - start, f"调用失败: {type(e).__name__}: {str(e)[:200]}"))
+                if index == last:
+                    self.stats.record(attempts, failed=True)
+                    raise
+                continue
+            reason = None
+            if index < last:
+                for judge in self.judges:
+                    reason = judge(messages, answer)
+                    if reason is not None:
+                        break
+            attempts.append((name, time.perf_counter() - start, reason))
+            if reason is None:
+                break
+
+        self.stats.record(attempts)
+        answer.response_metadata["cascade"] = {
+            "tier": attempts[-1][0],
+            "escalations": len(attempts) - 1,
+            "rejections": [reason for _, _, reason in attempts if reason is not None]
+        }
+        return ChatResult(generations=[ChatGeneration(message=answer)])
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        answer = self._generate(messages, stop=stop, run_manager=run_manager, **kwargs).generations[0].message
+        chunk = ChatGenerationChunk(message=AIMessageChunk(
+            content=answer.content,
+            response_metadata=answer.response_metadata,
+            usage_metadata=answer.usage_metadata
+        ))
+        if run_manager:
+            run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+        yield chunk
+
+def _resolve_judges(judges: Sequence[Any], first_spec: Dict[str, str]) -> List[Any]:
+    """把评审器名称("json"、"heuristic"、"self_check")转换成评审器实例"""
+    from .models import get_chat_model
+
+    resolved = []
+    for judge in judges:
+        if judge == "json":
+            resolved.append(ParserJudge(JsonOutputParser()))
+        elif judge == "heuristic":
+            min_logprob = os.getenv("CASCADE_MIN_LOGPROB")
+            max_length = os.getenv("CASCADE_MAX_LENGTH")
+            resolved.append(HeuristicJudge(
+                min_length=int(os.getenv("CASCADE_MIN_LENGTH", 10)),
+                max_length=int(max_length) if max_length else None,
+                min_logprob=float(min_logprob) if min_logprob else None
+            ))
+        elif judge == "self_check":
+            # 自检模型经过AccountedChatModel，用量计入统计；不经过ROUTER_BACKENDS路由
+            resolved.append(SelfCheckJudge(get_chat_model({**first_spec, "router_backends": None})))
+        elif isinstance(judge, str):
+            raise ValueError(f"未知的评审器: {judge}，可选: json, heuristic, self_check")
+        else:
+            resolved.append(judge)
+    return resolved
+
+def cascade_enabled(model_kwargs: Optional[Dict[str, Any]] = None) -> bool:
+    """是否配置了级联模型(CASCADE_MODELS或model_kwargs中的cascade_models)"""
+    return bool((model_kwargs or {}).get("cascade_models") or os.getenv("CASCADE_MODELS"))
+
+def get_cascade_model(
+    model_kwargs: Optional[Dict[str, Any]] = None,
+    judges: Optional[Sequence[Any]] = None,
+    route: str = "default"
+) -> BaseChatModel:
+    """
+    获取级联聊天模型
+
+    层级来自CASCADE_MODELS(或model_kwargs中的cascade_models)，格式与ROUTER_BACKENDS相同，
+    按从小到大的顺序排列，例如：
+    ollama|http://localhost:11434|qwen2.5:1.5b;deepseek|https://api.deepseek.com/v1|deepseek-chat
+    没有配置级联时返回普通的聊天模型。相同模型参数、评审器和路由名称的调用共享同一个级联模型，
+    评审器实例按对象区分，应当传入长期存在的实例。
+
+    Args:
+        model_kwargs: 可选的模型参数
+        judges: 评审器实例或名称，默认使用CASCADE_JUDGES(逗号分隔，默认heuristic)
+        route: 路由名称，统计信息按路由汇总
+
+    Returns:
+        BaseChatModel: 级联聊天模型
+    """
+    from .models import get_chat_model
+
+    if not cascade_enabled(model_kwargs):
+        return get_chat_model(model_kwargs)
+
+    if judges is None:
+        judges = [name.strip() for name in os.getenv("CASCADE_JUDGES", "heuristic").split(",") if name.strip()]
+    key = (
+        json.dumps(model_kwargs or {}, sort_keys=True, default=str),
+        ",".join(judge if isinstance(judge, str) else str(id(judge)) for judge in judges),
+        route
+    )
+    model = _cascades.get(key)
+    if model is None:
+        with _cascades_lock:
+            if key not in _cascades:
+                _cascades[key] = _create_cascade_model(model_kwargs, judges, route)
+            model = _cascades[key]
+    return model
+
+def _create_cascade_model(
+    model_kwargs: Optional[Dict[str, Any]],
+    judges: Sequence[Any],
+    route: str
+) -> BaseChatModel:
+    """创建级联模型：各层级模型、评审器、路由统计，外面再包上用量统计和埋点回调"""
+    from .accounting import AccountedChatModel, get_token_budget
+    from .models import _build_model
+    from .router import parse_router_backends
+    from .telemetry import get_callbacks
+
+    specs = parse_router_backends((model_kwargs or {}).get("cascade_models") or os.getenv("CASCADE_MODELS"))
+    tiers = [_build_model(spec) for spec in specs]
+    tier_names = [f"{spec['model_type']}/{spec['model_name']}" for spec in specs]
+    resolved = _resolve_judges(judges, specs[0])
+
+    # 启发式评审器需要logprobs时，只向支持的OpenAI兼容后端请求
+    needs_logprobs = any(getattr(judge, "needs_logprobs", False) for judge in resolved)
+    tier_kwargs = [
+        {"logprobs": True} if needs_logprobs and spec["model_type"] != "ollama" else {}
+        for spec in specs
+    ]
+
+    model = CascadeChatModel(
+        inner=tiers[0],
+        tiers=tiers,
+        tier_names=tier_names,
+        tier_kwargs=tier_kwargs,
+        judges=resolved,
+        stats=get_route_stats(route, tier_names)
+    )
+    # 实际回答的层级不确定，用量按响应中的模型名称记录，输出上限由各层级自己的配置决定
+    model = AccountedChatModel(
+        inner=model,
+        model_type="cascade",
+        model_name=specs[0]["model_name"],
+        budget=get_token_budget()
+    )
+    callbacks = get_callbacks()
+    if callbacks:
+        model.callbacks = callbacks
+    return model
@@ -0,0 +1,427 @@
+"""
+LangChain录制/回放模块
+
+模型输出和延迟每次运行都不一样，前后性能对比的噪声很大。这个模块提供：
+- record: 把所有模型、嵌入和工具交互(请求、响应、流式块的时间)录制到压缩的录制文件中
+- replay: 从录制文件回放，不访问任何提供商，尽可能快地返回
+- replay_realtime: 回放时按录制时的原始耗时和流式块间隔等待
+
+回放发生在最底层的提供商模型上，所以限流、调度、路由、埋点等我们自己的代码照常运行，
+可以在没有提供商波动的情况下测量它们的开销。回放时不创建提供商客户端，也不需要API密钥。
+"""
+
+import os
+import gzip
+import json
+import time
+import base64
+import struct
+import atexit
+import hashlib
+import threading
+from typing import Any, Dict, Iterator, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models import BaseChatModel, LangSmithParams
+from langchain_core.messages import (
+    AIMessageChunk,
+    BaseMessage,
+    message_chunk_to_message,
+    messages_from_dict,
+    messages_to_dict
+)
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.tools import BaseTool, StructuredTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from .models import WrappedChatModel
+
+CASSETTE_MODES = ("record", "replay", "replay_realtime")
+
+# 不参与请求匹配的调用参数：输出上限由token预算按会话剩余额度动态计算，每次运行都可能不同
+_VOLATILE_KWARGS = ("max_tokens", "num_predict")
+
+_cassette: Optional["Cassette"] = None
+_cassette_lock = threading.Lock()
+
+class CassetteMiss(LookupError):
+    """回放时录制文件中没有对应的交互"""
+
+def _encode_vector(vector: List[float]) -> str:
+    """嵌入向量按float32小端序压缩成base64"""
+    return base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode("ascii")
+
+def _decode_vector(data: str) -> List[float]:
+    raw = base64.b64decode(data)
+    return list(struct.unpack(f"<{len(raw) // 4}f", raw))
+
+def _message_key(message: BaseMessage) -> Dict[str, Any]:
+    """
+    只取消息中决定请求语义的字段
+
+    消息id等每次运行都会变化的字段不参与匹配，否则回放时对话历史中的AI消息对不上录制时的请求。
+    """
+    return {
+        "type": message.type,
+        "content": message.content,
+        "name": message.name,
+        "tool_calls": getattr(message, "tool_calls", None),
+        "tool_call_id": getattr(message, "tool_call_id", None)
+    }
+
+class Cassette:
+    """
+    录制文件
+
+    交互按请求内容的哈希分组，同一个请求录制多次时按录制顺序依次回放，超出后重复最后一次。
+    文件格式为gzip压缩的JSON。录制时后台线程定期写入文件，进程异常退出时最多丢失最后一个间隔的交互。
+    """
+
+    def __init__(self, path: str, mode: str):
+        if mode not in CASSETTE_MODES:
+            raise ValueError(f"未知的录制模式: {mode}，可选: {', '.join(CASSETTE_MODES)}")
+        self.path = path
+        self.mode = mode
+        self.interactions: Dict[str, List[Dict[str, Any]]] = {}
+        self._cursors: Dict[str, int] = {}
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        if self.replaying:
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"录制文件不存在: {path}，请先用CASSETTE_MODE=record录制")
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                self.interactions = json.load(f)["interactions"]
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode != "record"
+
+    @property
+    def realtime(self) -> bool:
+        return self.mode == "replay_realtime"
+
+    @staticmethod
+    def key(kind: str, target: str, request: Any) -> str:
+        """请求的匹配键"""
+        payload = json.dumps([kind, target, request], sort_keys=True, ensure_ascii=False, default=str)
+        return f"{kind}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]}"
+
+    def record(self, key: str, entry: Dict[str, Any]):
+        with self._lock:
+            self.interactions.setdefault(key, []).append(entry)
+            self._dirty = True
+
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        """按录制顺序取出下一条交互，没有录制过时返回None"""
+        with self._lock:
+            entries = self.interactions.get(key)
+            if not entries:
+                return None
+            cursor = self._cursors.get(key, 0)
+            self._cursors[key] = cursor + 1
+            return entries[min(cursor, len(entries) - 1)]
+
+    def wait(self, seconds: float):
+        """replay_realtime模式下按原始耗时等待"""
+        if self.realtime and seconds > 0:
+            time.sleep(seconds)
+
+    def save(self):
+        """把录制的交互写入文件(先写临时文件再替换，避免中断时留下损坏的文件)"""
+        with self._save_lock:
+            # 只在序列化时持有录制锁，压缩和写文件期间不阻塞正在录制的请求
+            with self._lock:
+                if self.replaying or not self._dirty:
+                    return
+                data = json.dumps(
+                    {"version": 1, "interactions": self.interactions},
+                    ensure_ascii=False,
+                    separators=(",", ":"),
+                    default=str
+                )
+                self._dirty = False
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+
+    def autosave(self, interval: float):
+        """在后台线程中定期保存录制的交互"""
+        while True:
+            time.sleep(interval)
+            try:
+                self.save()
+            except Exception as e:
+                print(f"保存录制文件时出错: {str(e)}")
+
+def cassette_mode() -> Optional[str]:
+    """当前的录制模式(CASSETTE_MODE)，未开启时返回None"""
+    mode = os.getenv("CASSETTE_MODE", "").strip().lower()
+    return mode or None
+
+def get_cassette() -> Optional[Cassette]:
+    """
+    获取进程内共享的录制文件
+
+    Returns:
+        Optional[Cassette]: 未设置CASSETTE_MODE时返回None
+    """
+    global _cassette
+    mode = cassette_mode()
+    if mode is None:
+        return None
+    with _cassette_lock:
+        if _cassette is None:
+            _cassette = Cassette(os.getenv("CASSETTE_PATH", "cassettes/default.json.gz"), mode)
+            if mode == "record":
+                atexit.register(_cassette.save)
+                threading.Thread(
+                    target=_cassette.autosave,
+                    args=(float(os.getenv("CASSETTE_FLUSH_INTERVAL", 5)),),
+                    name="cassette-autosave",
+                    daemon=True
+                ).start()
+        return _cassette
+
+class ReplayChatModel(BaseChatModel):
+    """
+    回放模式下代替提供商模型的占位模型
+
+    不创建提供商客户端，也不需要API密钥；请求都由外层的CassetteChatModel从录制文件回放。
+    工具按OpenAI的函数调用格式绑定，与录制时ChatOpenAI.bind_tools生成的参数一致。
+    """
+
+    provider: str
+    model_name: str
+
+    @property
+    def _llm_type(self) -> str:
+        return f"replay-{self.provider}"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"model_name": self.model_name}
+
+    def _get_ls_params(self, stop: Optional[List[str]] = None, **kwargs: Any) -> LangSmithParams:
+        params = LangSmithParams(ls_provider=self.provider, ls_model_name=self.model_name, ls_model_type="chat")
+        if stop:
+            params["ls_stop"] = stop
+        return params
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        raise CassetteMiss(f"回放模式下不会调用提供商({self.provider}/{self.model_name})")
+
+    def bind_tools(self, tools: List[Any], tool_choice: Optional[Any] = None, **kwargs: Any):
+        if tool_choice is not None:
+            if tool_choice == "any":
+                tool_choice = "required"
+            elif isinstance(tool_choice, str) and tool_choice not in ("auto", "none", "required"):
+                tool_choice = {"type": "function", "function": {"name": tool_choice}}
+            kwargs["tool_choice"] = tool_choice
+        return self.bind(tools=[convert_to_openai_tool(tool) for tool in tools], **kwargs)
+
+class CassetteChatModel(WrappedChatModel):
+    """
+    录制或回放提供商响应的聊天模型
+
+    包裹在最底层的提供商模型外面。回放时inner是ReplayChatModel，不会被调用，只用于把工具转换成提供商格式。
+    token预算注入的输出上限(max_tokens/num_predict)不参与请求匹配。
+    """
+
+    cassette: Any
+    target: str
+
+    @property
+    def _llm_type(self) -> str:
+        return f"cassette-{self.inner._llm_type}"
+
+    def _key(self, kind: str, messages: List[BaseMessage], stop: Optional[List[str]], kwargs: Dict[str, Any]) -> str:
+        return Cassette.key(kind, self.target, {
+            "messages": [_message_key(m) for m in messages],
+            "stop": stop,
+            "kwargs": {name: value for name, value in kwargs.items() if name not in _VOLATILE_KWARGS}
+        })
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        key = self._key("chat", messages, stop, kwargs)
+        if self.cassette.replaying:
+            entry = self.cassette.lookup(key)
+            if entry is None:
+                # 录制时用的是流式调用，把流式块合并成完整的回答
+                entry = self.cassette.lookup(self._key("chat_stream", messages, stop, kwargs))
+                if entry is None:
+                    raise CassetteMiss(f"录制文件中没有这个模型请求({self.target})，请重新录制")
+                self.cassette.wait(entry["chunks"][-1][0] if entry["chunks"] else 0)
+                return ChatResult(generations=[_merge_chunks(entry)])
+            self.cassette.wait(entry["latency"])
+            return ChatResult(
+                generations=[
+                    ChatGeneration(message=message, generation_info=info)
+                    for message, info in zip(messages_from_dict(entry["messages"]), entry["generation_info"])
+                ],
+                llm_output=entry["llm_output"]
+            )
+
+        start = time.perf_counter()
+        result = self.inner._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        self.cassette.record(key, {
+            "latency": time.perf_counter() - start,
+            "messages": messages_to_dict([generation.message for generation in result.generations]),
+            "generation_info": [generation.generation_info for generation in result.generations],
+            "llm_output": json.loads(json.dumps(result.llm_output, default=str))
+        })
+        return result
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        key = self._key("chat_stream", messages, stop, kwargs)
+        if self.cassette.replaying:
+            entry = self.cassette.lookup(key)
+            if entry is None:
+                # 录制时用的是非流式调用，把完整回答作为一个块输出
+                result = self._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                generation = result.generations[0]
+                chunk = ChatGenerationChunk(
+                    message=_to_chunk(generation.message),
+                    generation_info=generation.generation_info
+                )
+                if run_manager:
+                    run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+                return
+            previous = 0.0
+            for (offset, message), info in zip(entry["chunks"], entry["generation_info"]):
+                self.cassette.wait(offset - previous)
+                previous = offset
+                chunk = ChatGenerationChunk(message=messages_from_dict([message])[0], generation_info=info)
+                if run_manager:
+                    run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+                yield chunk
+            return
+
+        start = time.perf_counter()
+        chunks = []
+        infos = []
+        for chunk in self.inner._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            chunks.append([time.perf_counter() - start, messages_to_dict([chunk.message])[0]])
+            infos.append(chunk.generation_info)
+            yield chunk
+        self.cassette.record(key, {"chunks": chunks, "generation_info": infos})
+
+def _to_chunk(message: BaseMessage):
+    """把完整的AI消息转换成消息块"""
+    return AIMessageChunk(
+        content=message.content,
+        additional_kwargs=message.additional_kwargs,
+        response_metadata=message.response_metadata,
+        tool_call_chunks=[
+            {"name": call["name"], "args": json.dumps(call["args"], ensure_ascii=False), "id": call["id"], "index": i}
+            for i, call in enumerate(getattr(message, "tool_calls", None) or [])
+        ],
+        usage_metadata=getattr(message, "usage_metadata", None),
+        id=message.id
+    )
+
+def _merge_chunks(entry: Dict[str, Any]) -> ChatGeneration:
+    """把录制的流式块合并成一个完整的回答"""
+    merged: Optional[ChatGenerationChunk] = None
+    for (_, message), info in zip(entry["chunks"], entry["generation_info"]):
+        chunk = ChatGenerationChunk(message=messages_from_dict([message])[0], generation_info=info)
+        merged = chunk if merged is None else merged + chunk
+    if merged is None:
+        raise CassetteMiss("录制的流式响应为空")
+    return ChatGeneration(message=message_chunk_to_message(merged.message), generation_info=merged.generation_info)
+
+class CassetteEmbeddings(Embeddings):
+    """
+    录制或回放嵌入请求，向量以float32压缩保存
+
+    回放时inner为None，不创建提供商客户端。
+    """
+
+    def __init__(self, inner: Optional[Embeddings], cassette: Cassette, target: str):
+        self.inner = inner
+        self.cassette = cassette
+        self.target = target
+
+    def _call(self, kind: str, request: Any, fn) -> List[List[float]]:
+        key = Cassette.key(kind, self.target, request)
+        if self.cassette.replaying:
+            entry = self.cassette.lookup(key)
+            if entry is None:
+                raise CassetteMiss(f"录制文件中没有这个嵌入请求({self.target})，请重新录制")
+            self.cassette.wait(entry["latency"])
+            return [_decode_vector(vector) for vector in entry["vectors"]]
+
+        start = time.perf_counter()
+        vectors = fn()
+        self.cassette.record(key, {
+            "latency": time.perf_counter() - start,
+            "vectors": [_encode_vector(vector) for vector in vectors]
+        })
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._call("embed_documents", texts, lambda: self.inner.embed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._call("embed_query", text, lambda: [self.inner.embed_query(text)])[0]
+
+def cassette_tool(tool: BaseTool) -> BaseTool:
+    """
+    录制或回放工具调用
+
+    未开启录制模式时原样返回工具。
+
+    Args:
+        tool: 原始工具
+
+    Returns:
+        BaseTool: 名称、描述和参数与原工具相同的工具
+    """
+    cassette = get_cassette()
+    if cassette is None:
+        return tool
+
+    def run(**kwargs: Any) -> Any:
+        key = Cassette.key("tool", tool.name, kwargs)
+        if cassette.replaying:
+            entry = cassette.lookup(key)
+            if entry is None:
+                raise CassetteMiss(f"录制文件中没有这个工具调用({tool.name})，请重新录制")
+            cassette.wait(entry["latency"])
+            return entry["output"]
+        start = time.perf_counter()
+        output = tool.invoke(kwargs)
+        cassette.record(key, {"latency": time.perf_counter() - start, "output": output})
+        return output
+
+    return StructuredTool.from_function(
+        func=run,
+        name=tool.name,
+        description=tool.description,
+        args_schema=tool.args_schema,
+        return_direct=tool.return_direct
+    )
@@ -7,12 +7,43 @@ LangChain链示例
 import os
 from typing import Dict, Any, Optional, List
 from dotenv import load_dotenv
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
+from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.pydantic_v1 import BaseModel, Field
 
 # 导入模型工具
 from .models import get_chat_model
+from .cascade import ParserJudge, cascade_enabled, get_cascade_model, get_cascade_stats
+from .map_reduce import get_map_reduce_chain
+from .prompts import get_chain, get_compiled_prompt, render_messages
+
+# 定义输出模式
+class MovieRecommendation(BaseModel):
+    title: str = Field(description="电影标题")
+    director: str = Field(description="导演名称")
+    year: int = Field(description="发行年份")
+    genre: str = Field(description="电影类型")
+    summary: str = Field(description="简短的电影概述")
+    reasons: List[str] = Field(description="推荐这部电影的理由列表")
+
+# Map-Reduce示例使用的长文档
+LONG_DOCUMENT = """古埃及文明发源于尼罗河流域，是世界上最早的文明之一。每年尼罗河泛滥带来的肥沃淤泥让两岸的农业高度发达，也让古埃及人发展出了精确的历法和测量技术。
+
+公元前3100年前后，上埃及和下埃及完成统一，第一王朝建立。此后的三千年里，古埃及经历了古王国、中王国和新王国等多个时期，法老被视为神在人间的化身。
+
+古王国时期是金字塔建造的黄金时代。吉萨的胡夫金字塔原高约146米，在此后的近四千年里一直是世界上最高的人造建筑。金字塔的建造需要大量工匠和劳动者，考古发现表明他们并非奴隶，而是领取报酬的工人。
+
+古埃及人发明了象形文字，并把它刻在神庙墙壁和石碑上，或写在用纸莎草制成的纸上。1799年发现的罗塞塔石碑刻有同一段内容的三种文字，商博良据此在1822年破译了象形文字。
+
+宗教在古埃及社会中处于核心地位。古埃及人相信死后世界的存在，因此会把遗体制成木乃伊，并在墓中放置食物、器具和《亡灵书》，帮助死者顺利进入来世。
+
+新王国时期，古埃及的疆域达到顶峰。拉美西斯二世在位66年，修建了阿布辛贝神庙等宏伟建筑。图坦卡蒙的陵墓在1922年被完整发现，出土了黄金面具等大量珍贵文物。
+
+公元前30年，埃及艳后克娄巴特拉七世去世，埃及成为罗马帝国的一个行省，古埃及文明的独立历史就此结束。但它在建筑、数学、医学和文字方面的成就深刻影响了后来的地中海世界。"""
+
+# JSON输出解析器在模块级别创建一次，这样使用它的链也能被缓存复用
+MOVIE_PARSER = JsonOutputParser(pydantic_object=MovieRecommendation)
+# 级联模型按评审器实例缓存，评审器同样只创建一次
+MOVIE_JUDGE = ParserJudge(MOVIE_PARSER)
 
 def simple_chain_example(model_kwargs: Optional[Dict[str, Any]] = None):
     """
@@ -23,19 +54,8 @@ def simple_chain_example(model_kwargs: Optional[Dict[str, Any]] = None):
     """
     print("\n=== 简单链示例 ===")
 
-    # 创建提示模板
-    prompt = ChatPromptTemplate.from_template(
-        "给我{topic}的5个有趣事实，用简洁的语言描述。"
-    )
-    
-    # 创建模型
-    model = get_chat_model(model_kwargs)
-    
-    # 创建输出解析器
-    output_parser = StrOutputParser()
-    
-    # 组合成链
-    chain = prompt | model | output_parser
+    # 从注册表获取链：提示模板 | 模型 | 字符串输出解析器
+    chain = get_chain("chain.facts", model_kwargs)
     
     # 运行链
     topic = "古埃及"
@@ -54,20 +74,11 @@ def sequential_chain_example(model_kwargs: Optional[Dict[str, Any]] = None):
     """
     print("\n=== 顺序链示例 ===")
 
-    # 创建模型
-    model = get_chat_model(model_kwargs)
-    
     # 第一个链：生成故事主题
-    topic_prompt = ChatPromptTemplate.from_template(
-        "生成一个有趣的故事主题，包含以下元素：{element1}和{element2}。只返回主题，不要写故事。"
-    )
-    topic_chain = topic_prompt | model | StrOutputParser()
+    topic_chain = get_chain("chain.story_topic", model_kwargs)
     
     # 第二个链：根据主题写故事
-    story_prompt = ChatPromptTemplate.from_template(
-        "根据以下主题写一个简短的故事（不超过200字）：\n\n{topic}"
-    )
-    story_chain = story_prompt | model | StrOutputParser()
+    story_chain = get_chain("chain.story", model_kwargs)
     
     # 运行第一个链
     element1 = "时间旅行"
@@ -91,38 +102,13 @@ def json_output_chain_example(model_kwargs: Optional[Dict[str, Any]] = None):
     """
     print("\n=== JSON输出链示例 ===")
 
-    # 定义输出模式
-    class MovieRecommendation(BaseModel):
-        title: str = Field(description="电影标题")
-        director: str = Field(description="导演名称")
-        year: int = Field(description="发行年份")
-        genre: str = Field(description="电影类型")
-        summary: str = Field(description="简短的电影概述")
-        reasons: List[str] = Field(description="推荐这部电影的理由列表")
-    
-    # 创建提示模板
-    prompt = ChatPromptTemplate.from_template(
-        """根据用户的喜好推荐一部电影。
-        用户喜好: {preferences}
-        
-        以JSON格式返回一部电影推荐，包含以下字段:
-        - title: 电影标题
-        - director: 导演名称
-        - year: 发行年份(数字)
-        - genre: 电影类型
-        - summary: 简短的电影概述
-        - reasons: 推荐这部电影的理由列表(至少3个理由)
-        """
-    )
-    
-    # 创建模型
-    model = get_chat_model(model_kwargs)
-    
-    # 创建JSON输出解析器
-    output_parser = JsonOutputParser(pydantic_object=MovieRecommendation)
-    
-    # 组合成链
-    chain = prompt | model | output_parser
+    if cascade_enabled(model_kwargs):
+        # 配置了级联模型时，先用小模型回答，JSON解析或模式校验失败才升级到大模型
+        cascade = get_cascade_model(model_kwargs, judges=[MOVIE_JUDGE], route="chain.movie_recommendation")
+        chain = get_compiled_prompt("chain.movie_recommendation").as_runnable() | cascade | MOVIE_PARSER
+    else:
+        # 从注册表获取链：提示模板 | 模型 | JSON输出解析器
+        chain = get_chain("chain.movie_recommendation", model_kwargs, output_parser=MOVIE_PARSER)
     
     # 运行链
     preferences = "我喜欢科幻电影，特别是那些探索人类与技术关系的电影。我也喜欢有深度的剧情和令人惊讶的结局。"
@@ -143,16 +129,47 @@ def json_output_chain_example(model_kwargs: Optional[Dict[str, Any]] = None):
         print("推荐理由:")
         for i, reason in enumerate(result['reasons'], 1):
             print(f"  {i}. {reason}")
+        if cascade_enabled(model_kwargs):
+            stats = get_cascade_stats()["chain.movie_recommendation"]
+            print(f"级联统计: 升级率{stats['escalation_rate']:.0%}，各层级回答次数{stats['answered_by']}")
         print()
     except Exception as e:
         print(f"获取电影推荐时出错: {str(e)}")
         print("原始响应内容:")
-        raw_response = model.invoke(prompt.format_prompt(preferences=preferences).to_messages())
+        model = get_chat_model(model_kwargs)
+        raw_response = model.invoke(render_messages("chain.movie_recommendation", preferences=preferences))
         print(raw_response.content)
         print()
 
+def map_reduce_chain_example(model_kwargs: Optional[Dict[str, Any]] = None):
+    """
+    Map-Reduce链示例
+    
+    Args:
+        model_kwargs: 可选的模型参数，包括model_type和model_name
+    """
+    print("\n=== Map-Reduce链示例 ===")
+
+    # 把长文档切成小块，并行总结每一块，再树形合并
+    chain = get_map_reduce_chain(model_kwargs, chunk_size=200, chunk_overlap=0, fan_in=3)
+    
+    # 按完成顺序输出每一块和每次合并的结果
+    for step in chain.iter_steps(LONG_DOCUMENT):
+        if step["stage"] == "final":
+            print(f"\n最终总结:\n{step['output']}")
+        else:
+            print(f"[{step['stage']} 第{step['level']}层 #{step['index']}] {step['output'][:60]}...")
+    
+    # 修改其中一段后再次运行，只有变化的块和它上层的合并会重新调用模型
+    edited = LONG_DOCUMENT.replace("在位66年", "在位约66年")
+    steps = list(chain.iter_steps(edited))
+    recomputed = sum(1 for step in steps if not step["cached"])
+    print(f"\n修改一段后重新运行: 共{len(steps)}次调用，其中{recomputed}次重新计算，其余来自缓存")
+    print()
+
 if __name__ == "__main__":
     # 如果直接运行此文件，使用默认模型
     simple_chain_example()
     sequential_chain_example()
-    json_output_chain_example()
\ No newline at end of file
+    json_output_chain_example()
+    map_reduce_chain_example()
\ No newline at end of file
@@ -9,10 +9,10 @@ from typing import Dict, Any, Optional
 from dotenv import load_dotenv
 from langchain_core.language_models import BaseChatModel
 from langchain_core.messages import HumanMessage, SystemMessage
-from langchain_core.prompts import ChatPromptTemplate
 
 # 导入模型工具
 from .models import get_chat_model
+from .prompts import get_chain
 
 def basic_chat_example(model_kwargs: Optional[Dict[str, Any]] = None):
     """
@@ -69,17 +69,8 @@ def chat_with_prompt_template(model_kwargs: Optional[Dict[str, Any]] = None):
     """
     print("\n=== 使用提示模板的聊天示例 ===")
 
-    # 创建聊天提示模板
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "你是一位专家{role}。你的任务是{task}。"),
-        ("human", "{input}")
-    ])
-    
-    # 初始化聊天模型
-    chat = get_chat_model(model_kwargs)
-    
-    # 创建链
-    chain = prompt | chat
+    # 从注册表获取链：模板只编译一次，相同模型参数的链会被复用
+    chain = get_chain("chat.expert", model_kwargs, output_parser=None)
     
     # 运行链
     response = chain.invoke({
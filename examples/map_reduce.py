@@ -0,0 +1,199 @@
+"""
+LangChain并行Map-Reduce模块
+
+长文档无法放进一个提示时，需要先切分、逐块处理再合并。这个模块提供了一个Map-Reduce链：
+- map阶段：用文本切分器切块，按并发上限并行调用`提示模板 | 模型 | StrOutputParser`
+- reduce阶段：树形合并，每一层的合并调用也并行执行
+- 流式输出：可以逐步拿到每个块和每次合并的结果，最后一次合并按token流式输出
+- 缓存：按内容哈希缓存每个块(以及每次合并)的输出，修改文档后只重新处理变化的部分
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from .prompts import get_chain
+
+# 全局输出缓存：(阶段模板, 模型参数, 输入哈希) -> 输出
+_cache: "OrderedDict[str, str]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+def _cache_key(prompt_name: str, model_key: str, text: str) -> str:
+    return hashlib.sha256(f"{prompt_name}\0{model_key}\0{text}".encode("utf-8")).hexdigest()
+
+def _cache_get(key: str) -> Optional[str]:
+    with _cache_lock:
+        value = _cache.get(key)
+        if value is not None:
+            _cache.move_to_end(key)
+        return value
+
+def _cache_put(key: str, value: str):
+    max_size = int(os.getenv("MAP_REDUCE_CACHE_SIZE", 1024))
+    with _cache_lock:
+        _cache[key] = value
+        _cache.move_to_end(key)
+        while len(_cache) > max_size:
+            _cache.popitem(last=False)
+
+class MapReduceChain(Runnable[str, str]):
+    """
+    并行Map-Reduce链
+
+    输入是完整的长文本，输出是合并后的结果。除了invoke和stream之外，
+    iter_steps可以按完成顺序逐个返回每个块和每次合并的中间结果。
+    """
+
+    def __init__(
+        self,
+        model_kwargs: Optional[Dict[str, Any]] = None,
+        map_prompt: str = "map_reduce.map",
+        reduce_prompt: str = "map_reduce.reduce",
+        chunk_size: int = 2000,
+        chunk_overlap: int = 100,
+        fan_in: int = 4,
+        max_concurrency: int = 8
+    ):
+        if fan_in < 2:
+            raise ValueError("fan_in至少为2")
+        self.map_prompt = map_prompt
+        self.reduce_prompt = reduce_prompt
+        self.map_chain = get_chain(map_prompt, model_kwargs)
+        self.reduce_chain = get_chain(reduce_prompt, model_kwargs)
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        self.fan_in = fan_in
+        self.max_concurrency = max_concurrency
+        self.model_key = json.dumps(model_kwargs or {}, sort_keys=True, default=str)
+
+    def _run_stage(
+        self,
+        stage: str,
+        level: int,
+        prompt_name: str,
+        chain: Runnable,
+        inputs: List[str],
+        config: Optional[RunnableConfig]
+    ) -> Iterator[Dict[str, Any]]:
+        """并行执行一个阶段，已缓存的输入不再调用模型，按完成顺序产出结果"""
+        keys = [_cache_key(prompt_name, self.model_key, text) for text in inputs]
+        pending: List[int] = []
+        for index, key in enumerate(keys):
+            cached = _cache_get(key)
+            if cached is None:
+                pending.append(index)
+            else:
+                yield {"stage": stage, "level": level, "index": index, "output": cached, "cached": True}
+
+        if not pending:
+            return
+        batch_config = {**(config or {}), "max_concurrency": self.max_concurrency}
+        for position, output in chain.batch_as_completed(
+            [{"text": inputs[index]} for index in pending], batch_config
+        ):
+            index = pending[position]
+            _cache_put(keys[index], output)
+            yield {"stage": stage, "level": level, "index": index, "output": output, "cached": False}
+
+    def _group(self, outputs: List[str]) -> List[str]:
+        return [
+            "\n\n".join(outputs[i:i + self.fan_in])
+            for i in range(0, len(outputs), self.fan_in)
+        ]
+
+    def _iter_intermediate(
+        self,
+        text: str,
+        config: Optional[RunnableConfig],
+        final: List[Tuple[str, Runnable, str, int]]
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        执行除最后一次调用之外的所有阶段
+
+        最后一次调用(只有一个块时是map，否则是最顶层的reduce)放进final，由调用方决定是否流式执行。
+        """
+        chunks = self.splitter.split_text(text)
+        if len(chunks) <= 1:
+            final.append((self.map_prompt, self.map_chain, chunks[0], 0))
+            return
+
+        stage, level, prompt_name, chain, inputs = "map", 0, self.map_prompt, self.map_chain, chunks
+        while True:
+            outputs: List[str] = [""] * len(inputs)
+            for event in self._run_stage(stage, level, prompt_name, chain, inputs, config):
+                outputs[event["index"]] = event["output"]
+                yield event
+            inputs = self._group(outputs)
+            level += 1
+            if len(inputs) == 1:
+                break
+            stage, prompt_name, chain = "reduce", self.reduce_prompt, self.reduce_chain
+        final.append((self.reduce_prompt, self.reduce_chain, inputs[0], level))
+
+    def _final(self, final: List[Tuple[str, Runnable, str, int]]) -> Tuple[Runnable, str, str, Optional[str]]:
+        """返回最后一次调用的(链, 输入, 缓存键, 已缓存的输出)"""
+        prompt_name, chain, text, _ = final[0]
+        key = _cache_key(prompt_name, self.model_key, text)
+        return chain, text, key, _cache_get(key)
+
+    def iter_steps(self, input: str, config: Optional[RunnableConfig] = None) -> Iterator[Dict[str, Any]]:
+        """
+        按完成顺序产出每个块和每次合并的结果
+
+        每一项包含stage(map/reduce/final)、level、index、output和cached，最后一项是最终结果。
+        """
+        if not input.strip():
+            # 空文档不调用模型
+            yield {"stage": "final", "level": 0, "index": 0, "output": "", "cached": False}
+            return
+        final: List[Tuple[str, Runnable, str, int]] = []
+        yield from self._iter_intermediate(input, config, final)
+        chain, text, key, output = self._final(final)
+        cached = output is not None
+        if not cached:
+            output = chain.invoke({"text": text}, config)
+            _cache_put(key, output)
+        yield {"stage": "final", "level": final[0][3], "index": 0, "output": output, "cached": cached}
+
+    def invoke(self, input: str, config: Optional[RunnableConfig] = None, **kwargs: Any) -> str:
+        result = ""
+        for step in self.iter_steps(input, config):
+            result = step["output"]
+        return result
+
+    def stream(self, input: str, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[str]:
+        """先完成map和中间层的合并，最后一次调用按token流式输出"""
+        if not input.strip():
+            return
+        final: List[Tuple[str, Runnable, str, int]] = []
+        for _ in self._iter_intermediate(input, config, final):
+            pass
+        chain, text, key, cached = self._final(final)
+        if cached is not None:
+            yield cached
+            return
+        pieces = []
+        for piece in chain.stream({"text": text}, config):
+            pieces.append(piece)
+            yield piece
+        _cache_put(key, "".join(pieces))
+
+def get_map_reduce_chain(model_kwargs: Optional[Dict[str, Any]] = None, **kwargs: Any) -> MapReduceChain:
+    """
+    创建Map-Reduce链
+
+    并发上限默认来自MAP_REDUCE_MAX_CONCURRENCY(默认8)，其余参数见MapReduceChain。
+
+    Args:
+        model_kwargs: 可选的模型参数，包括model_type和model_name
+
+    Returns:
+        MapReduceChain: Map-Reduce链
+    """
+    kwargs.setdefault("max_concurrency", int(os.getenv("MAP_REDUCE_MAX_CONCURRENCY", 8)))
+    return MapReduceChain(model_kwargs, **kwargs)
@@ -7,13 +7,14 @@ LangChain记忆(Memory)示例
 import os
 from typing import Dict, Any, Optional
 from dotenv import load_dotenv
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain.chains import ConversationChain
 from langchain.memory import ConversationBufferMemory, ConversationSummaryMemory
 from langchain_core.messages import HumanMessage, AIMessage
 
 # 导入模型工具
 from .models import get_chat_model
+from .prompts import get_prompt
+from .telemetry import traced_memory
 
 def conversation_buffer_memory_example(model_kwargs: Optional[Dict[str, Any]] = None):
     """
@@ -25,14 +26,10 @@ def conversation_buffer_memory_example(model_kwargs: Optional[Dict[str, Any]] =
     print("\n=== 对话缓冲记忆示例 ===")
 
     # 创建记忆组件
-    memory = ConversationBufferMemory(return_messages=True)
+    memory = traced_memory(ConversationBufferMemory, return_messages=True)
     
-    # 创建提示模板
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "你是一位友好的AI助手，能够记住对话历史。"),
-        MessagesPlaceholder(variable_name="history"),
-        ("human", "{input}")
-    ])
+    # 从注册表获取提示模板(只构建一次)
+    prompt = get_prompt("memory.conversation")
     
     # 创建模型
     model = get_chat_model(model_kwargs)
@@ -80,17 +77,14 @@ def conversation_summary_memory_example(model_kwargs: Optional[Dict[str, Any]] =
     model = get_chat_model(model_kwargs)
     
     # 创建记忆组件 - 使用相同的模型进行摘要
-    memory = ConversationSummaryMemory(
+    memory = traced_memory(
+        ConversationSummaryMemory,
         llm=model,
         return_messages=True
     )
     
-    # 创建提示模板
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", "你是一位友好的AI助手，能够记住对话历史。"),
-        MessagesPlaceholder(variable_name="history"),
-        ("human", "{input}")
-    ])
+    # 从注册表获取提示模板(只构建一次)
+    prompt = get_prompt("memory.conversation")
     
     # 创建对话链
     conversation = ConversationChain(
@@ -6,11 +6,18 @@ LangChain模型配置模块
 
 import os
 import requests
-from typing import Dict, Any, Literal, Optional, List, TypedDict
+from typing import Dict, Any, Literal, Optional, List, TypedDict, Iterator, Sequence
 from dotenv import load_dotenv
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
 from langchain_core.language_models import BaseChatModel
-from langchain_openai import ChatOpenAI
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_community.chat_models import ChatOllama
+from langchain_ollama import OllamaEmbeddings
+
+from .ollama_residency import get_residency_manager, keep_alive_for
 
 # 定义模型类型
 ModelType = Literal["openai", "deepseek", "ollama"]
@@ -18,16 +25,60 @@ ModelType = Literal["openai", "deepseek", "ollama"]
 # 加载环境变量
 load_dotenv()
 
-def get_chat_model(model_kwargs: Optional[Dict[str, Any]] = None) -> BaseChatModel:
+def _env_flag(name: str, default: bool = False) -> bool:
+    """读取布尔类型的环境变量"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+class WrappedChatModel(BaseChatModel):
     """
-    获取聊天模型实例
-    
-    Args:
-        model_kwargs: 可选的模型参数，包括model_type和model_name
-        
-    Returns:
-        BaseChatModel: 聊天模型实例
+    包装另一个聊天模型的基类
+
+    默认把生成、流式输出、工具绑定和标识参数都委托给内部模型，子类只需覆盖需要增强的部分
+    (调度、路由、限流等)。
     """
+
+    inner: BaseChatModel
+
+    @property
+    def _llm_type(self) -> str:
+        return f"wrapped-{self.inner._llm_type}"
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return self.inner._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        yield from self.inner._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return self.inner._identifying_params
+
+    def _get_ls_params(self, stop: Optional[List[str]] = None, **kwargs: Any):
+        # 埋点和LangSmith读取的提供商和模型名称来自实际的底层模型，而不是包装类的类名
+        return self.inner._get_ls_params(stop=stop, **kwargs)
+
+    def bind_tools(self, tools: Sequence[Any], **kwargs: Any):
+        # 由内部模型负责把工具转换成提供商格式，再把参数绑定到包装模型上
+        bound = self.inner.bind_tools(tools, **kwargs)
+        return self.bind(**bound.kwargs)
+
+def _load_config(model_kwargs: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """从环境变量和model_kwargs合并出模型配置"""
     # 获取默认配置
     config = {}
     
@@ -36,9 +87,13 @@ def get_chat_model(model_kwargs: Optional[Dict[str, Any]] = None) -> BaseChatMod
     config["api_base"] = os.getenv("API_BASE")
     config["api_key"] = os.getenv("API_KEY")
     config["model"] = os.getenv("MODEL_NAME")
+    config["embedding_model"] = os.getenv("EMBEDDING_MODEL")
     config["temperature"] = float(os.getenv("TEMPERATURE", 0.7))
     config["max_tokens"] = int(os.getenv("MAX_TOKENS", 1000))
     config["top_p"] = float(os.getenv("TOP_P", 1.0))
+    config["scheduler"] = _env_flag("SCHEDULER_ENABLED")
+    config["router_backends"] = os.getenv("ROUTER_BACKENDS")
+    config["rate_limit"] = _env_flag("RATE_LIMIT_ENABLED")
     
     # 如果提供了model_kwargs，则更新配置
     if model_kwargs:
@@ -46,23 +101,169 @@ def get_chat_model(model_kwargs: Optional[Dict[str, Any]] = None) -> BaseChatMod
             config["model_type"] = model_kwargs["model_type"]
         if model_kwargs.get("model_name"):
             config["model"] = model_kwargs["model_name"]
+        if model_kwargs.get("api_base"):
+            config["api_base"] = model_kwargs["api_base"]
+        if model_kwargs.get("embedding_model"):
+            config["embedding_model"] = model_kwargs["embedding_model"]
+        if "router_backends" in model_kwargs:
+            config["router_backends"] = model_kwargs["router_backends"]
+        if "scheduler" in model_kwargs:
+            config["scheduler"] = bool(model_kwargs["scheduler"])
+        if "rate_limit" in model_kwargs:
+            config["rate_limit"] = bool(model_kwargs["rate_limit"])
     
-    # 根据模型类型创建相应的模型实例
+    return config
+
+def _create_model(config: Dict[str, Any]) -> BaseChatModel:
+    """根据配置创建底层的聊天模型实例"""
     if config["model_type"] == "ollama":
+        extra = {}
+        keep_alive = keep_alive_for(config["model"])
+        if keep_alive is not None:
+            # 没有配置OLLAMA_KEEP_ALIVE时不传，使用Ollama服务端的默认值
+            extra["keep_alive"] = keep_alive
         return ChatOllama(
             base_url=config["api_base"],
             model=config["model"],
-            temperature=config["temperature"]
+            temperature=config["temperature"],
+            num_predict=config["max_tokens"],
+            **extra
         )
     else:
+        extra = {}
+        if config["rate_limit"]:
+            # 由客户端限流器负责重试，并读取响应头中的限流信息
+            extra = {"max_retries": 0, "include_response_headers": True}
         return ChatOpenAI(
             api_key=config["api_key"],
             base_url=config["api_base"],
             model=config["model"],
             temperature=config["temperature"],
             max_tokens=config["max_tokens"],
-            top_p=config["top_p"]
+            top_p=config["top_p"],
+            **extra
+        )
+
+def get_chat_model(model_kwargs: Optional[Dict[str, Any]] = None) -> BaseChatModel:
+    """
+    获取聊天模型实例
+    
+    Args:
+        model_kwargs: 可选的模型参数，包括model_type和model_name
+        
+    Returns:
+        BaseChatModel: 聊天模型实例
+    """
+    config = _load_config(model_kwargs)
+    
+    # 配置了多个后端时，使用路由模型在各后端之间做负载均衡和故障转移
+    if config["router_backends"]:
+        from .router import get_router_model
+        model = get_router_model(config["router_backends"], _build_model)
+    else:
+        model = _build_model(model_kwargs)
+    
+    # 统计token用量和费用，并按配置的预算裁剪或拒绝请求
+    from .accounting import AccountedChatModel, get_token_budget
+    model = AccountedChatModel(
+        inner=model,
+        model_type="router" if config["router_backends"] else config["model_type"],
+        model_name=config["model"] or "",
+        budget=get_token_budget()
+    )
+    
+    # 启用埋点时，模型调用、首token时间和token数都会被记录
+    from .telemetry import get_callbacks
+    callbacks = get_callbacks()
+    if callbacks:
+        model.callbacks = callbacks
+    
+    return model
+
+def _build_model(model_kwargs: Optional[Dict[str, Any]] = None) -> BaseChatModel:
+    """创建单个后端的聊天模型，并按配置加上限流和请求调度"""
+    config = _load_config(model_kwargs)
+    
+    # 录制/回放模式下，提供商的响应从录制文件中读写，上层的限流、调度等照常运行；
+    # 回放时不创建提供商客户端，也不需要API密钥
+    from .cassette import CassetteChatModel, ReplayChatModel, get_cassette
+    cassette = get_cassette()
+    if cassette is not None and cassette.replaying:
+        model = ReplayChatModel(provider=config["model_type"] or "", model_name=config["model"] or "")
+    else:
+        model = _create_model(config)
+    if cassette is not None:
+        model = CassetteChatModel(
+            inner=model,
+            cassette=cassette,
+            target=f"{config['model_type']}|{config['api_base']}|{config['model']}"
+        )
+    
+    # 启用限流时，请求先在本地令牌桶上排队，被提供商限流时退避重试
+    if config["rate_limit"]:
+        from .rate_limit import RateLimitedChatModel, get_rate_limiter
+        model = RateLimitedChatModel(
+            inner=model,
+            limiter=get_rate_limiter(f"{config['model_type']}:{config['api_base']}:{config['model']}"),
+            max_tokens=config["max_tokens"]
+        )
+    
+    # 启用请求调度时，相同的并发请求会被合并，兼容的请求会被微批处理
+    if config["scheduler"]:
+        from .scheduler import ScheduledChatModel, get_scheduler
+        model = ScheduledChatModel(
+            inner=model,
+            scheduler=get_scheduler(config["model_type"], f"{config['api_base']}/{config['model']}")
+        )
+    
+    return model
+
+def get_embeddings(model_kwargs: Optional[Dict[str, Any]] = None) -> Embeddings:
+    """
+    获取嵌入模型实例
+    
+    默认使用OpenAI的默认嵌入模型(读取OPENAI_API_KEY)。设置了EMBEDDING_MODEL时，
+    使用当前配置的后端(MODEL_TYPE和API_BASE)上的这个嵌入模型，例如Ollama的nomic-embed-text。
+    
+    Args:
+        model_kwargs: 可选的模型参数，包括model_type和model_name
+        
+    Returns:
+        Embeddings: 嵌入模型实例
+    """
+    config = _load_config(model_kwargs)
+    
+    if not config["embedding_model"]:
+        model_type, api_base, model = "openai", None, OpenAIEmbeddings.model_fields["model"].default
+        create = lambda: OpenAIEmbeddings()
+    elif config["model_type"] == "ollama":
+        model_type, api_base, model = "ollama", config["api_base"], config["embedding_model"]
+        create = lambda: OllamaEmbeddings(base_url=api_base, model=model)
+    else:
+        model_type, api_base, model = config["model_type"], config["api_base"], config["embedding_model"]
+        create = lambda: OpenAIEmbeddings(api_key=config["api_key"], base_url=api_base, model=model)
+    
+    from .cassette import CassetteEmbeddings, get_cassette
+    cassette = get_cassette()
+    if cassette is None:
+        embeddings = create()
+    else:
+        # 回放时不创建提供商客户端
+        embeddings = CassetteEmbeddings(
+            None if cassette.replaying else create(),
+            cassette,
+            f"{model_type}|{api_base}|{model}"
         )
+    
+    # 启用请求调度时，并发的单条查询会合并成一次批量嵌入请求
+    if config["scheduler"]:
+        from .scheduler import BatchedEmbeddings, get_embedding_batcher
+        embeddings = BatchedEmbeddings(
+            inner=embeddings,
+            batcher=get_embedding_batcher(model_type, api_base, model, embeddings)
+        )
+    
+    return embeddings
 
 def get_model_info() -> Dict[str, Dict[str, Any]]:
     """
@@ -82,7 +283,8 @@ def get_model_info() -> Dict[str, Dict[str, Any]]:
         },
         "ollama": {
             "available": False,
-            "models": []
+            "models": [],
+            "loaded": []
         }
     }
     
@@ -108,8 +310,23 @@ def get_model_info() -> Dict[str, Dict[str, Any]]:
                 model_info["ollama"]["models"] = [model["name"] for model in models_data["models"]]
             else:
                 model_info["ollama"]["models"] = ["llama2", "mistral", "gemma", "deepseek-r1"]
-    except:
+    except Exception:
         # 如果无法连接到Ollama服务，则使用默认模型列表
         model_info["ollama"]["models"] = ["llama2", "mistral", "gemma", "deepseek-r1"]
     
+    # 获取当前已加载到内存中的模型；旧版本Ollama没有/api/ps，失败时不影响上面的模型列表
+    if model_info["ollama"]["available"]:
+        try:
+            model_info["ollama"]["loaded"] = [
+                {
+                    "name": model["name"],
+                    "size": model.get("size", 0),
+                    "size_vram": model.get("size_vram", 0),
+                    "expires_at": model.get("expires_at")
+                }
+                for model in get_residency_manager(ollama_url).loaded_models()
+            ]
+        except Exception:
+            model_info["ollama"]["loaded"] = []
+    
     return model_info
\ No newline at end of file
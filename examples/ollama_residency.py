@@ -0,0 +1,226 @@
+"""
+Ollama模型常驻管理模块
+
+Ollama在模型空闲一段时间后会把它从内存中卸载，下一次请求需要重新加载，耗时可达数秒。
+这个模块负责：
+- 启动时预加载选定的模型并发送预热请求
+- 按OLLAMA_KEEP_ALIVE为每个模型设置keep_alive，让常用模型保持常驻(未配置时使用Ollama服务端的默认值)
+- 通过/api/ps跟踪已加载的模型，配置了多个模型时按内存预算调度加载和卸载
+"""
+
+import os
+import time
+import threading
+from typing import Any, Dict, List, Optional, Union
+
+import requests
+
+_managers: Dict[str, "OllamaResidencyManager"] = {}
+_managers_lock = threading.Lock()
+
+def parse_keep_alive(spec: Optional[str], default: Optional[str] = None) -> Dict[str, Optional[str]]:
+    """
+    解析keep_alive配置
+
+    支持单个值("30m"、"-1"表示永久常驻)，或逗号分隔的按模型配置，例如：
+    "deepseek-r1:7b=1h,llama2=5m,10m"，其中不带模型名的一项作为默认值。
+
+    Returns:
+        Dict: 模型名到keep_alive的映射，默认值的键为"*"，没有默认值时为None
+    """
+    result = {"*": default}
+    if not spec:
+        return result
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "=" in item:
+            model, value = item.split("=", 1)
+            result[model.strip()] = value.strip()
+        else:
+            result["*"] = item
+    return result
+
+def keep_alive_for(model: Optional[str]) -> Optional[Union[int, str]]:
+    """
+    返回指定模型的keep_alive配置，没有配置时返回None，请求中不带keep_alive，由Ollama服务端决定
+
+    Ollama要求纯数字的keep_alive以数字类型传递(单位秒，-1表示永久常驻)。
+    """
+    config = parse_keep_alive(os.getenv("OLLAMA_KEEP_ALIVE"))
+    value = config.get(model or "", config["*"])
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+def preload_enabled() -> bool:
+    """是否在启动时预加载Ollama模型(OLLAMA_PRELOAD=true或配置了OLLAMA_PRELOAD_MODELS)"""
+    if os.getenv("OLLAMA_PRELOAD_MODELS", "").strip():
+        return True
+    return os.getenv("OLLAMA_PRELOAD", "false").strip().lower() in ("1", "true", "yes", "on")
+
+class OllamaResidencyManager:
+    """
+    单个Ollama服务的模型常驻管理器
+
+    memory_budget为None时不主动卸载模型，由Ollama自己管理；设置后加载新模型前会先卸载
+    最久未使用的模型，保证已加载模型的总大小不超过预算。Ollama每处理一个请求都会刷新模型的
+    过期时间(/api/ps的expires_at)，所以按过期时间排序就能反映包括推理请求在内的实际使用情况。
+    """
+
+    def __init__(self, base_url: str, memory_budget: Optional[int] = None, timeout: float = 300.0):
+        self.base_url = base_url.rstrip("/")
+        self.memory_budget = memory_budget
+        self.timeout = timeout
+        self._lock = threading.Lock()
+
+    def loaded_models(self) -> List[Dict[str, Any]]:
+        """通过/api/ps获取当前已加载的模型(名称、大小、显存占用和过期时间)"""
+        response = requests.get(f"{self.base_url}/api/ps", timeout=5)
+        response.raise_for_status()
+        return response.json().get("models", [])
+
+    def model_sizes(self) -> Dict[str, int]:
+        """通过/api/tags获取模型文件大小，用于估算加载后占用的内存"""
+        response = requests.get(f"{self.base_url}/api/tags", timeout=5)
+        response.raise_for_status()
+        return {model["name"]: model.get("size", 0) for model in response.json().get("models", [])}
+
+    def _generate(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        if payload.get("keep_alive") is None:
+            payload.pop("keep_alive", None)
+        response = requests.post(f"{self.base_url}/api/generate", json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def preload(self, model: str) -> float:
+        """
+        加载模型并设置keep_alive(不带prompt的generate请求只加载模型)
+
+        Returns:
+            float: 加载耗时(秒)
+        """
+        start = time.perf_counter()
+        self._generate({"model": model, "keep_alive": keep_alive_for(model)})
+        return time.perf_counter() - start
+
+    def warmup(self, model: str, prompt: str = "你好") -> float:
+        """
+        发送一个只生成1个token的预热请求
+
+        Returns:
+            float: 预热请求耗时(秒)
+        """
+        start = time.perf_counter()
+        self._generate({
+            "model": model,
+            "prompt": prompt,
+            "stream": False,
+            "keep_alive": keep_alive_for(model),
+            "options": {"num_predict": 1}
+        })
+        return time.perf_counter() - start
+
+    def unload(self, model: str):
+        """立即卸载模型(keep_alive=0)"""
+        self._generate({"model": model, "keep_alive": 0})
+
+    def _make_room(self, model: str, loaded: List[Dict[str, Any]]):
+        """按内存预算卸载最久未使用的其他模型，直到能放下新模型"""
+        if self.memory_budget is None:
+            return
+        needed = self.model_sizes().get(model, 0)
+        others = [m for m in loaded if m["name"] != model]
+        in_use = sum(m.get("size", 0) for m in others)
+        # 最早过期的模型最久没有收到请求，排在前面；同一服务返回的时间格式一致，可以直接比较字符串
+        others.sort(key=lambda m: m.get("expires_at", ""))
+        while others and in_use + needed > self.memory_budget:
+            victim = others.pop(0)
+            print(f"内存预算不足，卸载模型: {victim['name']}")
+            self.unload(victim["name"])
+            in_use -= victim.get("size", 0)
+
+    def ensure_loaded(self, model: str, warmup: bool = False) -> Dict[str, Any]:
+        """
+        确保模型已加载，必要时先按内存预算卸载其他模型
+
+        Args:
+            model: 模型名称
+            warmup: 加载后是否发送预热请求
+
+        Returns:
+            Dict: 本次操作的耗时统计
+        """
+        with self._lock:
+            loaded = self.loaded_models()
+            result = {"model": model, "already_loaded": any(m["name"] == model for m in loaded)}
+            if not result["already_loaded"]:
+                self._make_room(model, loaded)
+                result["load_seconds"] = self.preload(model)
+            if warmup:
+                result["warmup_seconds"] = self.warmup(model)
+            return result
+
+    def start(self, models: List[str], warmup: bool = True) -> List[Dict[str, Any]]:
+        """启动时依次预加载并预热所有配置的模型"""
+        results = []
+        for model in models:
+            try:
+                results.append(self.ensure_loaded(model, warmup=warmup))
+            except Exception as e:
+                results.append({"model": model, "error": str(e)})
+        return results
+
+def get_residency_manager(base_url: Optional[str] = None) -> OllamaResidencyManager:
+    """
+    获取(或创建)指定Ollama服务的常驻管理器
+
+    Args:
+        base_url: Ollama服务地址，默认使用API_BASE
+
+    Returns:
+        OllamaResidencyManager: 常驻管理器
+    """
+    base_url = base_url or os.getenv("API_BASE", "http://localhost:11434")
+    with _managers_lock:
+        if base_url not in _managers:
+            budget = os.getenv("OLLAMA_MEMORY_BUDGET_GB")
+            _managers[base_url] = OllamaResidencyManager(
+                base_url,
+                memory_budget=int(float(budget) * 1024 ** 3) if budget else None
+            )
+        return _managers[base_url]
+
+def preload_models(model_name: Optional[str] = None, base_url: Optional[str] = None) -> List[Dict[str, Any]]:
+    """
+    按配置预加载并预热Ollama模型
+
+    预加载的模型来自OLLAMA_PRELOAD_MODELS(逗号分隔)，未配置时使用当前选择的模型。
+
+    Args:
+        model_name: 当前选择的模型
+        base_url: Ollama服务地址
+
+    Returns:
+        List: 每个模型的加载和预热耗时
+    """
+    models = [m.strip() for m in os.getenv("OLLAMA_PRELOAD_MODELS", "").split(",") if m.strip()]
+    if not models:
+        models = [model_name or os.getenv("MODEL_NAME")]
+    models = [m for m in models if m]
+
+    print(f"正在预加载Ollama模型: {', '.join(models)}")
+    results = get_residency_manager(base_url).start(models)
+    for result in results:
+        if "error" in result:
+            print(f"  - {result['model']}: 预加载失败 ({result['error']})")
+        elif result["already_loaded"]:
+            print(f"  - {result['model']}: 已常驻，预热耗时{result['warmup_seconds']:.2f}秒")
+        else:
+            print(f"  - {result['model']}: 加载耗时{result['load_seconds']:.2f}秒，"
+                  f"预热耗时{result['warmup_seconds']:.2f}秒")
+    return results
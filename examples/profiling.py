@@ -0,0 +1,356 @@
+"""
+LangChain示例性能分析模块
+
+这个模块可以用以下分析器包裹任意一次示例运行：
+- cprofile: 确定性分析，输出.prof文件和调用关系图
+- sampling: 墙钟采样分析，定期采集所有线程的调用栈，输出可直接生成火焰图的折叠栈
+- tracemalloc: 内存分配快照
+
+每次运行生成一个独立的报告目录，报告把耗时划分为：我们自己的代码、LangChain框架开销、
+客户端库开销和等待提供商响应的时间，方便判断变慢的原因。
+"""
+
+import os
+import sys
+import time
+import json
+import cProfile
+import pstats
+import threading
+import tracemalloc
+import sysconfig
+import unicodedata
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional
+
+PROFILERS = ("cprofile", "sampling", "tracemalloc")
+
+# 耗时分类
+CATEGORIES = {
+    "app": "示例代码",
+    "framework": "LangChain框架",
+    "client": "HTTP/SDK客户端",
+    "provider_wait": "等待提供商响应/I/O",
+    "other": "其他(标准库等)"
+}
+
+_PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_SELF_FILE = os.path.abspath(__file__)
+_STDLIB_DIR = sysconfig.get_paths()["stdlib"]
+_FRAMEWORK_PACKAGES = ("langchain", "langsmith", "pydantic")
+_CLIENT_PACKAGES = ("openai", "httpx", "httpcore", "h11", "anyio", "requests", "urllib3", "ollama", "aiohttp")
+# 阻塞在网络I/O上的标准库模块和内置函数
+_WAIT_MODULES = ("socket.py", "ssl.py", "selectors.py")
+_WAIT_BUILTINS = ("_ssl.", "_socket.", "select.", "selectors", "getaddrinfo", "_thread.")
+# 阻塞在锁、条件变量、Future和队列上的标准库函数(线程池里的模型调用通过它们等待)
+_BLOCKING_MODULES = ("threading.py", "_base.py", "queue.py")
+_BLOCKING_FUNCTIONS = ("wait", "acquire", "result", "get", "join", "_wait_for_tstate_lock")
+
+def _package_of(filename: str) -> Optional[str]:
+    """返回文件所属的第三方包名"""
+    marker = "site-packages" + os.sep
+    index = filename.find(marker)
+    if index < 0:
+        return None
+    return filename[index + len(marker):].split(os.sep, 1)[0]
+
+def classify(filename: str, funcname: str = "") -> str:
+    """
+    根据函数所在文件把耗时归类
+
+    Args:
+        filename: 函数所在文件，内置函数为"~"
+        funcname: 函数名，用于识别内置的socket/ssl调用
+
+    Returns:
+        str: CATEGORIES中的分类
+    """
+    if filename == "~":
+        return "provider_wait" if any(name in funcname for name in _WAIT_BUILTINS) else "other"
+    package = _package_of(filename)
+    if package is not None:
+        if package.startswith(_FRAMEWORK_PACKAGES):
+            return "framework"
+        if package.startswith(_CLIENT_PACKAGES):
+            return "client"
+        return "other"
+    if filename.startswith(_STDLIB_DIR):
+        return "provider_wait" if os.path.basename(filename) in _WAIT_MODULES else "other"
+    filename = os.path.abspath(filename)
+    if filename == _SELF_FILE:
+        # 分析器自身(包括profile_run)的开销不算作示例代码
+        return "other"
+    if filename.startswith(_PROJECT_DIR):
+        return "app"
+    return "other"
+
+def _is_blocking_wait(code) -> bool:
+    """判断栈帧是否阻塞在锁、条件变量、Future或队列上"""
+    return (
+        code.co_filename.startswith(_STDLIB_DIR)
+        and os.path.basename(code.co_filename) in _BLOCKING_MODULES
+        and code.co_name in _BLOCKING_FUNCTIONS
+    )
+
+def _pad(text: str, width: int) -> str:
+    """按显示宽度补齐空格，中文字符占两列"""
+    display = sum(2 if unicodedata.east_asian_width(char) in ("W", "F") else 1 for char in text)
+    return text + " " * max(0, width - display)
+
+def _format_breakdown(title: str, totals: Dict[str, float], unit: str) -> List[str]:
+    """把分类统计格式化为报告中的一节"""
+    grand_total = sum(totals.values()) or 1.0
+    lines = [title]
+    for category, label in CATEGORIES.items():
+        value = totals.get(category, 0.0)
+        lines.append(f"  {_pad(label, 18)} {value:>12.3f}{unit}  {value / grand_total:6.1%}")
+    return lines
+
+class CProfileProfiler:
+    """cProfile确定性分析(只统计调用run的线程)"""
+
+    name = "cprofile"
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        self.profile = cProfile.Profile()
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self):
+        self.profile.disable()
+
+    def report(self) -> Dict[str, Any]:
+        prof_path = os.path.join(self.output_dir, "cprofile.prof")
+        self.profile.dump_stats(prof_path)
+        stats = pstats.Stats(self.profile)
+
+        totals: Dict[str, float] = defaultdict(float)
+        for (filename, _, funcname), (_, _, tottime, _, _) in stats.stats.items():
+            totals[classify(filename, funcname)] += tottime
+
+        # 调用关系图：按累计耗时排序的前30个函数及其被调用者
+        callgraph_path = os.path.join(self.output_dir, "cprofile_callgraph.txt")
+        with open(callgraph_path, "w", encoding="utf-8") as f:
+            callgraph = pstats.Stats(self.profile, stream=f)
+            callgraph.sort_stats("cumulative").print_stats(30)
+            callgraph.print_callees(30)
+
+        lines = _format_breakdown("[cProfile] 按自身耗时(tottime)分类:", totals, "s")
+        lines.append(f"  调用数据: {prof_path} (可用snakeviz或gprof2dot查看)")
+        lines.append(f"  调用关系: {callgraph_path}")
+        return {"lines": lines, "totals": dict(totals)}
+
+class SamplingProfiler:
+    """
+    墙钟采样分析
+
+    后台线程定期读取所有线程的调用栈，按最内层有意义的栈帧归类，
+    因此线程池里的模型调用和等待网络的时间也会被统计到。
+    """
+
+    name = "sampling"
+
+    def __init__(self, output_dir: str, interval: float = 0.005):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.stacks: Counter = Counter()
+        self.totals: Dict[str, float] = defaultdict(float)
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _frame_category(self, frame) -> str:
+        """
+        按栈帧归类
+
+        最内层栈帧阻塞在锁、Future或网络I/O上时算作等待；否则沿调用栈由内向外
+        找到第一个不是标准库的栈帧，走到分析器自身的栈帧时停止。
+        """
+        if _is_blocking_wait(frame.f_code):
+            return "provider_wait"
+        current = frame
+        while current is not None and os.path.abspath(current.f_code.co_filename) != _SELF_FILE:
+            category = classify(current.f_code.co_filename, current.f_code.co_name)
+            if category != "other":
+                return category
+            current = current.f_back
+        return "other"
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        last = time.perf_counter()
+        while not self._stop.wait(self.interval):
+            # 按实际经过的时间计权，采样本身的开销不会让统计时间偏小
+            now = time.perf_counter()
+            elapsed, last = now - last, now
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                names = []
+                categories = set()
+                current = frame
+                while current is not None:
+                    code = current.f_code
+                    categories.add(classify(code.co_filename, code.co_name))
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{current.f_lineno})")
+                    current = current.f_back
+                # 跳过没有执行任何相关代码的空闲线程(例如等待任务的线程池工作线程)
+                if thread_id != threading.main_thread().ident and categories <= {"other"}:
+                    continue
+                self.samples += 1
+                self.totals[self._frame_category(frame)] += elapsed
+                self.stacks[";".join(reversed(names))] += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def report(self) -> Dict[str, Any]:
+        folded_path = os.path.join(self.output_dir, "sampling.folded")
+        with open(folded_path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+        lines = _format_breakdown(
+            f"[采样] 共{self.samples}个样本，间隔{self.interval * 1000:.0f}ms，按墙钟时间分类(多线程时会累加):",
+            self.totals,
+            "s"
+        )
+        lines.append(f"  折叠栈: {folded_path} (可用flamegraph.pl或speedscope生成火焰图)")
+        return {"lines": lines, "totals": dict(self.totals), "samples": self.samples}
+
+class TracemallocProfiler:
+    """tracemalloc内存分配快照"""
+
+    name = "tracemalloc"
+
+    def __init__(self, output_dir: str, frames: int = 25):
+        self.output_dir = output_dir
+        self.frames = frames
+        self.snapshot = None
+        self.peak = 0
+
+    def start(self):
+        tracemalloc.start(self.frames)
+
+    def stop(self):
+        self.snapshot = tracemalloc.take_snapshot()
+        _, self.peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    def report(self) -> Dict[str, Any]:
+        snapshot = self.snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")
+        ])
+        totals: Dict[str, float] = defaultdict(float)
+        for stat in snapshot.statistics("filename"):
+            totals[classify(stat.traceback[0].filename)] += stat.size / 1024
+
+        top_path = os.path.join(self.output_dir, "tracemalloc_top.txt")
+        with open(top_path, "w", encoding="utf-8") as f:
+            for stat in snapshot.statistics("traceback")[:30]:
+                f.write(f"{stat.size / 1024:.1f} KiB, {stat.count}个对象\n")
+                for line in stat.traceback.format(limit=10):
+                    f.write(f"  {line}\n")
+                f.write("\n")
+
+        lines = _format_breakdown(
+            f"[tracemalloc] 峰值{self.peak / 1024 / 1024:.2f} MiB，运行结束时仍存活的内存按分类:",
+            totals,
+            "KiB"
+        )
+        lines.append(f"  分配热点: {top_path}")
+        return {"lines": lines, "totals": dict(totals), "peak_bytes": self.peak}
+
+_PROFILER_CLASSES = {
+    "cprofile": CProfileProfiler,
+    "sampling": SamplingProfiler,
+    "tracemalloc": TracemallocProfiler
+}
+
+def parse_profilers(value: str) -> List[str]:
+    """
+    解析逗号分隔的分析器列表
+
+    Raises:
+        ValueError: 包含未知的分析器
+    """
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in names if name not in PROFILERS]
+    if unknown or not names:
+        raise ValueError(f"未知的分析器: {', '.join(unknown) or value}，可选: {', '.join(PROFILERS)}")
+    return names
+
+def profile_run(
+    fn: Callable[[], Any],
+    profilers: List[str],
+    label: str,
+    output_root: str = "profiles"
+) -> str:
+    """
+    在指定分析器下运行fn并生成报告
+
+    Args:
+        fn: 要分析的函数
+        profilers: 分析器名称列表
+        label: 报告名称，例如"example1"
+        output_root: 报告根目录
+
+    Returns:
+        str: 报告目录
+    """
+    output_dir = os.path.join(output_root, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{label}")
+    os.makedirs(output_dir, exist_ok=True)
+
+    # tracemalloc开销最大，放在最外层，避免把其他分析器的内存也算进去
+    instances = [_PROFILER_CLASSES[name](output_dir) for name in PROFILERS if name in profilers]
+    for profiler in instances:
+        profiler.start()
+    start = time.perf_counter()
+    error = None
+    try:
+        fn()
+    except Exception as e:
+        error = e
+    finally:
+        elapsed = time.perf_counter() - start
+        for profiler in reversed(instances):
+            profiler.stop()
+
+    results = {profiler.name: profiler.report() for profiler in instances}
+    lines = [
+        f"性能分析报告: {label}",
+        f"墙钟时间: {elapsed:.3f}s",
+        f"分析器: {', '.join(results)}"
+    ]
+    if error is not None:
+        lines.append(f"运行出错: {type(error).__name__}: {error}")
+    for result in results.values():
+        lines.append("")
+        lines.extend(result.pop("lines"))
+
+    report_text = "\n".join(lines)
+    with open(os.path.join(output_dir, "report.txt"), "w", encoding="utf-8") as f:
+        f.write(report_text + "\n")
+    with open(os.path.join(output_dir, "report.json"), "w", encoding="utf-8") as f:
+        json.dump(
+            {"label": label, "elapsed": elapsed, "error": str(error) if error else None, "profilers": results},
+            f,
+            ensure_ascii=False,
+            indent=2
+        )
+
+    print("\n" + report_text)
+    print(f"\n报告已保存到: {output_dir}")
+    if error is not None:
+        raise error
+    return output_dir
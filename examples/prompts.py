@@ -0,0 +1,284 @@
+"""
+LangChain提示模板注册表
+
+这个模块集中定义了所有示例用到的提示模板，并且：
+- 每个模板只在第一次使用时构建和校验一次ChatPromptTemplate，之后重复使用
+- 把模板字符串预编译成"字面量/变量"片段，渲染时直接拼接，不再重复解析模板和校验变量
+- 缓存组合好的`prompt | model | parser`链，相同参数的调用共享同一个链和模型客户端
+"""
+
+import json
+import threading
+from string import Formatter
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, convert_to_messages
+from langchain_core.output_parsers import BaseOutputParser, StrOutputParser
+from langchain_core.prompt_values import ChatPromptValue
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.runnables import Runnable, RunnableLambda
+
+from .models import get_chat_model
+
+# 模板定义：每一项是(角色, 模板字符串)或MessagesPlaceholder
+PROMPTS: Dict[str, List[Union[Tuple[str, str], MessagesPlaceholder]]] = {
+    "chat.expert": [
+        ("system", "你是一位专家{role}。你的任务是{task}。"),
+        ("human", "{input}")
+    ],
+    "chain.facts": [
+        ("human", "给我{topic}的5个有趣事实，用简洁的语言描述。")
+    ],
+    "chain.story_topic": [
+        ("human", "生成一个有趣的故事主题，包含以下元素：{element1}和{element2}。只返回主题，不要写故事。")
+    ],
+    "chain.story": [
+        ("human", "根据以下主题写一个简短的故事（不超过200字）：\n\n{topic}")
+    ],
+    "chain.movie_recommendation": [
+        ("human", """根据用户的喜好推荐一部电影。
+        用户喜好: {preferences}
+        
+        以JSON格式返回一部电影推荐，包含以下字段:
+        - title: 电影标题
+        - director: 导演名称
+        - year: 发行年份(数字)
+        - genre: 电影类型
+        - summary: 简短的电影概述
+        - reasons: 推荐这部电影的理由列表(至少3个理由)
+        """)
+    ],
+    "map_reduce.map": [
+        ("human", "以下是一篇长文档的一部分。请用简洁的语言总结这一部分的要点：\n\n{text}")
+    ],
+    "map_reduce.reduce": [
+        ("human", "以下是同一篇文档不同部分的要点总结。请把它们合并成一份简洁、连贯的总结：\n\n{text}")
+    ],
+    "memory.conversation": [
+        ("system", "你是一位友好的AI助手，能够记住对话历史。"),
+        MessagesPlaceholder(variable_name="history"),
+        ("human", "{input}")
+    ],
+    "agent.basic": [
+        ("system", """你是一个有用的AI助手，可以使用提供的工具来回答用户的问题。
+        
+        可用工具:
+        - search_weather: 搜索指定位置的天气信息
+        - calculate: 计算数学表达式的结果
+        
+        使用工具时，请遵循以下格式:
+        思考: 我需要使用什么工具来回答这个问题？
+        行动: 工具名称
+        行动输入: 工具的输入参数
+        观察: 工具的输出结果
+        
+        当你有了足够的信息来回答用户的问题时，直接提供答案，不需要使用工具。
+        """),
+        MessagesPlaceholder(variable_name="chat_history"),
+        ("human", "{input}"),
+        MessagesPlaceholder(variable_name="agent_scratchpad"),
+    ],
+    "agent.retrieval": [
+        ("system", """你是一个有用的AI助手，可以使用提供的工具来回答用户的问题。
+        
+        可用工具:
+        - search_documents: 搜索文档库中与查询相关的信息
+        - calculate: 计算数学表达式的结果
+        
+        当用户询问的信息可能在文档库中时，请使用search_documents工具。
+        当需要进行数学计算时，请使用calculate工具。
+        
+        如果你不确定答案，请诚实地说出来，不要编造信息。
+        """),
+        MessagesPlaceholder(variable_name="chat_history"),
+        ("human", "{input}"),
+        MessagesPlaceholder(variable_name="agent_scratchpad"),
+    ],
+    "cascade.self_check": [
+        ("system", "你是一位严格的审核员。判断给出的回答是否正确、完整地回答了问题。只回答\"是\"或\"否\"。"),
+        ("human", "问题:\n{question}\n\n回答:\n{answer}")
+    ],
+}
+
+_MESSAGE_CLASSES = {
+    "system": SystemMessage,
+    "human": HumanMessage,
+    "ai": AIMessage
+}
+
+_templates: Dict[str, ChatPromptTemplate] = {}
+_compiled: Dict[str, "CompiledChatPrompt"] = {}
+_chains: Dict[Tuple[str, str, str], Runnable] = {}
+_lock = threading.RLock()
+_str_parser = StrOutputParser()
+
+def _compile_template(template: str) -> Tuple[Callable[[Dict[str, Any]], str], List[str]]:
+    """
+    把f-string风格的模板预编译成渲染函数
+
+    Returns:
+        Tuple: (渲染函数, 变量名列表)
+    """
+    parts: List[Tuple[str, Optional[str]]] = []
+    variables: List[str] = []
+    simple = True
+    for literal, field, spec, conversion in Formatter().parse(template):
+        if field is not None:
+            # 带格式说明或属性访问的变量交给str.format处理
+            if spec or conversion or not field.isidentifier():
+                simple = False
+            name = field.split(".", 1)[0].split("[", 1)[0]
+            if name not in variables:
+                variables.append(name)
+        parts.append((literal, field))
+
+    if not variables:
+        text = "".join(literal for literal, _ in parts)
+        return (lambda values: text), variables
+    if not simple:
+        return (lambda values: template.format(**values)), variables
+
+    def render(values: Dict[str, Any]) -> str:
+        return "".join(
+            literal + (str(values[field]) if field is not None else "")
+            for literal, field in parts
+        )
+
+    return render, variables
+
+class CompiledChatPrompt:
+    """
+    预编译的聊天提示模板
+
+    渲染时只做字符串拼接和消息对象创建，和ChatPromptTemplate的输出保持一致。
+    """
+
+    def __init__(self, name: str, spec: List[Union[Tuple[str, str], MessagesPlaceholder]]):
+        self.name = name
+        self._steps: List[Tuple[str, Any]] = []
+        variables: List[str] = []
+        for item in spec:
+            if isinstance(item, MessagesPlaceholder):
+                self._steps.append(("placeholder", item.variable_name))
+                names = [item.variable_name]
+            else:
+                role, template = item
+                render, names = _compile_template(template)
+                self._steps.append((role, render))
+            variables.extend(name for name in names if name not in variables)
+        self.input_variables = variables
+        self._runnable: Optional[Runnable] = None
+
+    def format_messages(self, **kwargs: Any) -> List[BaseMessage]:
+        """渲染成消息列表"""
+        missing = [name for name in self.input_variables if name not in kwargs]
+        if missing:
+            raise KeyError(f"提示模板'{self.name}'缺少变量: {', '.join(missing)}")
+        messages: List[BaseMessage] = []
+        for role, step in self._steps:
+            if role == "placeholder":
+                messages.extend(convert_to_messages(kwargs[step]))
+            else:
+                messages.append(_MESSAGE_CLASSES[role](content=step(kwargs)))
+        return messages
+
+    def as_runnable(self) -> Runnable:
+        """包装成可以放进`|`链中的Runnable，输出与ChatPromptTemplate相同的ChatPromptValue"""
+        if self._runnable is None:
+            self._runnable = RunnableLambda(
+                lambda inputs: ChatPromptValue(messages=self.format_messages(**inputs)),
+                name="CompiledChatPrompt"
+            )
+        return self._runnable
+
+def get_prompt(name: str) -> ChatPromptTemplate:
+    """
+    获取注册的ChatPromptTemplate(只构建一次)
+
+    用于需要BasePromptTemplate的场景，例如ConversationChain和create_openai_tools_agent。
+
+    Args:
+        name: 模板名称
+
+    Returns:
+        ChatPromptTemplate: 提示模板
+    """
+    template = _templates.get(name)
+    if template is None:
+        with _lock:
+            if name not in _templates:
+                if name not in PROMPTS:
+                    raise KeyError(f"未注册的提示模板: {name}")
+                _templates[name] = ChatPromptTemplate.from_messages(PROMPTS[name])
+            template = _templates[name]
+    return template
+
+def get_compiled_prompt(name: str) -> CompiledChatPrompt:
+    """
+    获取预编译的提示模板(只编译一次)
+
+    第一次编译时会和ChatPromptTemplate的输入变量做一次校验。
+    """
+    compiled = _compiled.get(name)
+    if compiled is None:
+        with _lock:
+            if name not in _compiled:
+                compiled = CompiledChatPrompt(name, PROMPTS[name])
+                expected = set(get_prompt(name).input_variables)
+                if set(compiled.input_variables) != expected:
+                    raise ValueError(
+                        f"提示模板'{name}'的变量不一致: {compiled.input_variables} != {sorted(expected)}"
+                    )
+                _compiled[name] = compiled
+            compiled = _compiled[name]
+    return compiled
+
+def render_messages(name: str, **kwargs: Any) -> List[BaseMessage]:
+    """
+    用预编译的模板渲染消息列表
+
+    Args:
+        name: 模板名称
+        **kwargs: 模板变量
+
+    Returns:
+        List[BaseMessage]: 消息列表
+    """
+    return get_compiled_prompt(name).format_messages(**kwargs)
+
+def get_chain(
+    name: str,
+    model_kwargs: Optional[Dict[str, Any]] = None,
+    output_parser: Union[str, BaseOutputParser, None] = "str"
+) -> Runnable:
+    """
+    获取缓存的`prompt | model | parser`链
+
+    相同模板、模型参数和解析器的调用共享同一个链，因此也共享模型实例和它的HTTP连接池。
+
+    Args:
+        name: 模板名称
+        model_kwargs: 可选的模型参数，包括model_type和model_name
+        output_parser: "str"表示StrOutputParser，None表示直接返回模型消息，
+            也可以传入一个长期存在的解析器实例
+
+    Returns:
+        Runnable: 组合好的链
+    """
+    if isinstance(output_parser, str):
+        if output_parser != "str":
+            raise ValueError(f"未知的输出解析器: {output_parser}")
+        output_parser = _str_parser
+    parser_key = "none" if output_parser is None else str(id(output_parser))
+    key = (name, json.dumps(model_kwargs or {}, sort_keys=True, default=str), parser_key)
+
+    chain = _chains.get(key)
+    if chain is None:
+        with _lock:
+            if key not in _chains:
+                chain = get_compiled_prompt(name).as_runnable() | get_chat_model(model_kwargs)
+                if output_parser is not None:
+                    chain = chain | output_parser
+                _chains[key] = chain
+            chain = _chains[key]
+    return chain
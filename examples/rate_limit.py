@@ -0,0 +1,340 @@
+"""
+LangChain客户端限流模块
+
+这个模块为每个后端维护两个令牌桶(每分钟请求数和每分钟token数)，请求在本地排队等待，
+而不是直接打到提供商后收到429错误：
+- 令牌桶的剩余量会根据提供商返回的x-ratelimit-*响应头进行校准
+- 收到429时按比例降低速率，之后逐步恢复到配额的目标比例(AIMD)
+- 被限流的请求使用带抖动的指数退避重试
+- 提供排队深度和等待时间等统计信息
+"""
+
+import os
+import re
+import time
+import random
+import threading
+from collections import deque
+from typing import Any, Dict, Iterator, List, Mapping, Optional
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+from .accounting import count_message_tokens
+from .models import WrappedChatModel
+
+# 全局限流器注册表，同一个后端模型的所有调用方共享配额
+_limiters: Dict[str, "RateLimiter"] = {}
+_limiters_lock = threading.Lock()
+
+def _parse_duration(value: Optional[str]) -> Optional[float]:
+    """解析"1s"、"6m0s"、"250ms"或纯数字格式的时长，返回秒数"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    units = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+    parts = re.findall(r"([\d.]+)(ms|h|m|s)", value)
+    if not parts:
+        return None
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+def estimate_tokens(messages: List[BaseMessage]) -> int:
+    """用本地分词器计算消息的token数"""
+    return count_message_tokens(messages)
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """判断异常是否为提供商的限流(429)或过载(503)错误"""
+    status = getattr(error, "status_code", None)
+    if status is None:
+        response = getattr(error, "response", None)
+        status = getattr(response, "status_code", None)
+    return status in (429, 503) or type(error).__name__ == "RateLimitError"
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """从异常携带的响应头中读取Retry-After"""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    return _parse_duration(headers.get("retry-after"))
+
+class TokenBucket:
+    """
+    令牌桶
+
+    reserve()允许桶内令牌变为负数(预支)，返回调用方需要等待的时间，
+    这样多个等待者会按到达顺序依次排队，而不是在令牌恢复时一起争抢。
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """预订amount个令牌，返回需要等待的秒数"""
+        with self._lock:
+            self._refill()
+            # 单个请求超过桶容量时按容量计算，否则永远无法满足
+            self.tokens -= min(amount, self.capacity)
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def adjust(self, amount: float):
+        """按实际用量修正之前的预订(正数表示多扣，负数表示退还)"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+    def sync(self, remaining: float):
+        """用提供商报告的剩余额度校准本地令牌数，只会往下修正"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, remaining)
+
+class RateLimiter:
+    """
+    单个后端的客户端限流器
+
+    同时按请求数和token数限流，并根据429错误自适应调整速率。
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+        target_utilization: float = 0.9,
+        max_retries: int = 5
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.target_utilization = target_utilization
+        self.max_retries = max_retries
+        # 速率系数：1.0表示按配额的目标比例发送，收到429后会临时降低
+        self.factor = 1.0
+        self.request_bucket = TokenBucket(
+            requests_per_minute * target_utilization / 60, requests_per_minute * target_utilization
+        )
+        self.token_bucket = TokenBucket(
+            tokens_per_minute * target_utilization / 60, tokens_per_minute * target_utilization
+        )
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.throttled = 0
+        self.retries = 0
+        self.requests = 0
+        self.wait_times = deque(maxlen=1000)
+        self._lock = threading.Lock()
+
+    def _apply_factor(self):
+        self.request_bucket.rate = self.requests_per_minute * self.target_utilization * self.factor / 60
+        self.token_bucket.rate = self.tokens_per_minute * self.target_utilization * self.factor / 60
+
+    def acquire(self, tokens: int) -> float:
+        """
+        排队等待直到可以发送请求
+
+        Args:
+            tokens: 本次请求预计消耗的token数
+
+        Returns:
+            float: 实际等待的秒数
+        """
+        with self._lock:
+            self.queue_depth += 1
+            self.requests += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        try:
+            wait = max(self.request_bucket.reserve(1), self.token_bucket.reserve(tokens))
+            if wait > 0:
+                time.sleep(wait)
+        finally:
+            with self._lock:
+                self.queue_depth -= 1
+                self.wait_times.append(wait)
+        return wait
+
+    def record_usage(self, estimated: int, actual: Optional[int]):
+        """请求完成后按实际token用量修正token桶"""
+        if actual is not None:
+            self.token_bucket.adjust(actual - estimated)
+
+    def record_success(self):
+        """请求成功后逐步恢复速率(加性增加)"""
+        with self._lock:
+            if self.factor < 1.0:
+                self.factor = min(1.0, self.factor + 0.05)
+                self._apply_factor()
+
+    def record_throttled(self):
+        """收到429后降低速率(乘性减少)"""
+        with self._lock:
+            self.throttled += 1
+            self.factor = max(0.1, self.factor * 0.7)
+            self._apply_factor()
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        """根据提供商的x-ratelimit-*响应头校准令牌桶"""
+        headers = {key.lower(): value for key, value in headers.items()}
+        for kind, bucket in (("requests", self.request_bucket), ("tokens", self.token_bucket)):
+            remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+            if remaining is None:
+                continue
+            try:
+                remaining = float(remaining)
+            except ValueError:
+                continue
+            try:
+                limit = float(headers.get(f"x-ratelimit-limit-{kind}", ""))
+            except ValueError:
+                limit = None
+            if limit:
+                # 以提供商报告的每分钟配额为准，并预留目标比例之外的余量
+                with self._lock:
+                    setattr(self, f"{kind}_per_minute", limit)
+                    bucket.capacity = limit * self.target_utilization
+                    self._apply_factor()
+                remaining -= limit * (1 - self.target_utilization)
+            bucket.sync(remaining)
+
+    def backoff(self, attempt: int, error: Exception) -> float:
+        """带抖动的指数退避时间(full jitter)，如果有Retry-After则不短于它"""
+        delay = random.uniform(0, min(60.0, 0.5 * (2 ** attempt)))
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def stats(self) -> Dict[str, Any]:
+        """返回排队深度、等待时间和限流统计"""
+        with self._lock:
+            waits = sorted(self.wait_times)
+        return {
+            "requests": self.requests,
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "avg_wait": sum(waits) / len(waits) if waits else 0.0,
+            "p95_wait": waits[int(len(waits) * 0.95) - 1] if len(waits) >= 20 else (waits[-1] if waits else 0.0),
+            "throttled": self.throttled,
+            "retries": self.retries,
+            "requests_per_minute": self.request_bucket.rate * 60,
+            "tokens_per_minute": self.token_bucket.rate * 60
+        }
+
+def get_rate_limiter(backend: str) -> RateLimiter:
+    """
+    获取(或创建)指定后端共享的限流器
+
+    Args:
+        backend: 后端标识，例如"deepseek:https://api.deepseek.com/v1:deepseek-chat"
+
+    Returns:
+        RateLimiter: 限流器
+    """
+    with _limiters_lock:
+        if backend not in _limiters:
+            _limiters[backend] = RateLimiter(
+                requests_per_minute=float(os.getenv("RATE_LIMIT_RPM", 60)),
+                tokens_per_minute=float(os.getenv("RATE_LIMIT_TPM", 100000)),
+                target_utilization=float(os.getenv("RATE_LIMIT_TARGET", 0.9)),
+                max_retries=int(os.getenv("RATE_LIMIT_MAX_RETRIES", 5))
+            )
+        return _limiters[backend]
+
+def get_rate_limit_stats() -> Dict[str, Dict[str, Any]]:
+    """返回所有限流器的统计信息"""
+    with _limiters_lock:
+        return {backend: limiter.stats() for backend, limiter in _limiters.items()}
+
+class RateLimitedChatModel(WrappedChatModel):
+    """
+    经过客户端限流的聊天模型
+
+    发送前在本地令牌桶上排队，被提供商限流时退避重试。
+    """
+
+    limiter: Any
+    max_tokens: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return f"rate-limited-{self.inner._llm_type}"
+
+    def _estimate(self, messages: List[BaseMessage]) -> int:
+        """预估本次请求的token消耗：输入估算加上输出上限"""
+        return estimate_tokens(messages) + self.max_tokens
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        estimated = self._estimate(messages)
+        attempt = 0
+        while True:
+            self.limiter.acquire(estimated)
+            try:
+                result = self.inner._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt >= self.limiter.max_retries:
+                    raise
+                self.limiter.record_throttled()
+                self.limiter.retries += 1
+                time.sleep(self.limiter.backoff(attempt, e))
+                attempt += 1
+                continue
+            break
+
+        self.limiter.record_success()
+        generation = result.generations[0] if result.generations else None
+        if generation is not None:
+            headers = (generation.generation_info or {}).get("headers")
+            if headers:
+                self.limiter.update_from_headers(headers)
+            usage = getattr(generation.message, "usage_metadata", None)
+            self.limiter.record_usage(estimated, usage["total_tokens"] if usage else None)
+        return result
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        estimated = self._estimate(messages)
+        attempt = 0
+        while True:
+            self.limiter.acquire(estimated)
+            started = False
+            try:
+                for chunk in self.inner._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    started = True
+                    headers = (chunk.generation_info or {}).get("headers")
+                    if headers:
+                        self.limiter.update_from_headers(headers)
+                    yield chunk
+            except Exception as e:
+                # 已经开始输出的流不能重试
+                if started or not is_rate_limit_error(e) or attempt >= self.limiter.max_retries:
+                    raise
+                self.limiter.record_throttled()
+                self.limiter.retries += 1
+                time.sleep(self.limiter.backoff(attempt, e))
+                attempt += 1
+                continue
+            self.limiter.record_success()
+            return
@@ -0,0 +1,241 @@
+"""
+LangChain检索后处理模块
+
+向量检索直接返回的top-k结果经常是几乎重复的片段，白白占用代理的上下文。这个模块在检索之后增加一个阶段：
+- 先多取一些候选(fetch_k)，再用最大边际相关性(MMR)去重和多样化
+- 可选的批量重排序(默认是基于关键词的BM25)，与向量相似度加权融合
+- 最后按token预算装填结果，再交给create_retriever_tool
+
+相似度、重排序和MMR都用NumPy矩阵运算批量完成，不对每个文档做Python循环。
+"""
+
+import os
+import re
+import hashlib
+from itertools import chain
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+
+from .accounting import count_tokens, truncate_tokens
+
+_TERM_PATTERN = re.compile(r"[a-z0-9]+|[一-鿿]+")
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms == 0, 1.0, norms)
+
+def _min_max(scores: np.ndarray) -> np.ndarray:
+    span = scores.max() - scores.min()
+    return np.zeros_like(scores) if span == 0 else (scores - scores.min()) / span
+
+def mmr_select(
+    relevance: np.ndarray,
+    similarity: np.ndarray,
+    k: int,
+    lambda_mult: float = 0.5
+) -> List[int]:
+    """
+    最大边际相关性选择
+
+    每一步只做一次向量化的打分和argmax，已选文档的最大相似度增量更新，复杂度为O(k·n)。
+
+    Args:
+        relevance: 每个候选与查询的相关度，形状为(n,)
+        similarity: 候选之间的相似度矩阵，形状为(n, n)
+        k: 选择的数量
+        lambda_mult: 相关度的权重，1表示只看相关度，0表示只看多样性
+
+    Returns:
+        List[int]: 选中的候选下标，按选择顺序排列
+    """
+    n = len(relevance)
+    if n == 0 or k <= 0:
+        return []
+    selected = [int(np.argmax(relevance))]
+    max_similarity = similarity[:, selected[0]].copy()
+    available = np.ones(n, dtype=bool)
+    available[selected[0]] = False
+    while len(selected) < min(k, n):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_similarity, similarity[:, best], out=max_similarity)
+    return selected
+
+class KeywordReranker:
+    """
+    基于关键词的BM25重排序
+
+    英文按单词、中文按相邻两个字切分。所有候选的词项展平后映射到查询词表的列，
+    用一次np.add.at构建词频矩阵，打分也是一次矩阵运算。
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+
+    @staticmethod
+    def _terms(text: str) -> List[str]:
+        terms = []
+        for token in _TERM_PATTERN.findall(text.lower()):
+            if token.isascii():
+                terms.append(token)
+            else:
+                terms.extend(token[i:i + 2] for i in range(max(1, len(token) - 1)))
+        return terms
+
+    def __call__(self, query: str, texts: Sequence[str]) -> np.ndarray:
+        vocabulary = {term: i for i, term in enumerate(dict.fromkeys(self._terms(query)))}
+        if not vocabulary or not texts:
+            return np.zeros(len(texts))
+
+        terms = [self._terms(text) for text in texts]
+        lengths = np.array([len(doc_terms) for doc_terms in terms], dtype=np.float64)
+        rows = np.repeat(np.arange(len(texts)), lengths.astype(np.intp))
+        # 只对不重复的词项查词表，再通过逆索引得到每个词项所在的列，不在词表中的为-1
+        unique, inverse = np.unique(np.array(list(chain.from_iterable(terms)), dtype=str), return_inverse=True)
+        columns = np.array([vocabulary.get(term, -1) for term in unique], dtype=np.intp)[inverse.ravel()]
+        matched = columns >= 0
+        tf = np.zeros((len(texts), len(vocabulary)))
+        np.add.at(tf, (rows[matched], columns[matched]), 1)
+
+        df = (tf > 0).sum(axis=0)
+        idf = np.log(1 + (len(texts) - df + 0.5) / (df + 0.5))
+        norm = self.k1 * (1 - self.b + self.b * lengths / max(lengths.mean(), 1.0))
+        return (idf * tf * (self.k1 + 1) / (tf + norm[:, None])).sum(axis=1)
+
+def pack_documents(documents: List[Document], token_budget: Optional[int], model: Optional[str] = None) -> List[Document]:
+    """
+    按排名顺序把文档装进token预算，放不下的文档跳过，继续尝试后面更短的文档
+
+    排名第一的文档总会保留，单独超出预算时截断到预算以内。
+
+    Args:
+        documents: 按排名排序的文档
+        token_budget: token预算，None表示不限制
+        model: 模型名称，用于选择分词器
+
+    Returns:
+        List[Document]: 装填后的文档
+    """
+    if token_budget is None:
+        return documents
+    packed = []
+    used = 0
+    for document in documents:
+        # 文档之间用空行拼接，按2个token计入分隔开销
+        cost = count_tokens(document.page_content, model) + 2
+        if not packed and cost > token_budget:
+            content = truncate_tokens(document.page_content, token_budget - 2, model)
+            packed.append(Document(page_content=content, metadata=document.metadata))
+            used = count_tokens(content, model) + 2
+        elif used + cost <= token_budget:
+            packed.append(document)
+            used += cost
+    return packed
+
+def _text_key(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+class DiversifiedRetriever(BaseRetriever):
+    """
+    多取候选、重排序、MMR多样化并按token预算装填的检索器
+
+    vectors保存文档内容哈希到向量的映射，建索引时已经算好的向量直接复用，
+    缺失的候选向量会用一次embed_documents批量补齐。
+    """
+
+    vector_store: Any
+    embeddings: Embeddings
+    vectors: Dict[str, Any] = {}
+    k: int = 4
+    fetch_k: int = 20
+    lambda_mult: float = 0.5
+    reranker: Optional[Callable[[str, Sequence[str]], Any]] = None
+    rerank_weight: float = 0.3
+    token_budget: Optional[int] = None
+    model_name: Optional[str] = None
+
+    def _candidate_vectors(self, documents: List[Document]) -> np.ndarray:
+        keys = [_text_key(document.page_content) for document in documents]
+        missing = [i for i, key in enumerate(keys) if key not in self.vectors]
+        if missing:
+            computed = self.embeddings.embed_documents([documents[i].page_content for i in missing])
+            for i, vector in zip(missing, computed):
+                self.vectors[keys[i]] = np.asarray(vector, dtype=np.float32)
+        return np.stack([self.vectors[key] for key in keys])
+
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        candidates = self.vector_store.similarity_search_by_vector(query_vector.tolist(), k=self.fetch_k)
+        if not candidates:
+            return []
+
+        matrix = _normalize_rows(self._candidate_vectors(candidates))
+        relevance = matrix @ _normalize_rows(query_vector)
+        if self.reranker is not None:
+            rerank_scores = np.asarray(self.reranker(query, [d.page_content for d in candidates]), dtype=np.float64)
+            relevance = (1 - self.rerank_weight) * _min_max(relevance) + self.rerank_weight * _min_max(rerank_scores)
+
+        selected = mmr_select(relevance, matrix @ matrix.T, self.k, self.lambda_mult)
+        return pack_documents([candidates[i] for i in selected], self.token_budget, self.model_name)
+
+def build_diversified_retriever(
+    documents: List[Document],
+    embeddings: Embeddings,
+    model_name: Optional[str] = None
+) -> DiversifiedRetriever:
+    """
+    为文档建立FAISS索引，并创建带MMR、重排序和token预算的检索器
+
+    文档向量只计算一次，同时用于建索引和MMR。参数来自环境变量：
+    RETRIEVAL_K、RETRIEVAL_FETCH_K、RETRIEVAL_MMR_LAMBDA、RETRIEVAL_RERANK(keyword或none)、
+    RETRIEVAL_RERANK_WEIGHT和RETRIEVAL_TOKEN_BUDGET。
+
+    Args:
+        documents: 要检索的文档
+        embeddings: 嵌入模型
+        model_name: 模型名称，用于按模型的分词器计算token预算
+
+    Returns:
+        DiversifiedRetriever: 检索器
+    """
+    from langchain_community.vectorstores import FAISS
+
+    texts = [document.page_content for document in documents]
+    vectors = embeddings.embed_documents(texts)
+    vector_store = FAISS.from_embeddings(
+        list(zip(texts, vectors)),
+        embeddings,
+        metadatas=[document.metadata for document in documents]
+    )
+
+    rerank = os.getenv("RETRIEVAL_RERANK", "keyword").strip().lower()
+    if rerank not in ("keyword", "none"):
+        raise ValueError(f"未知的重排序方式: {rerank}，可选: keyword, none")
+    token_budget = os.getenv("RETRIEVAL_TOKEN_BUDGET", "1000")
+
+    return DiversifiedRetriever(
+        vector_store=vector_store,
+        embeddings=embeddings,
+        vectors={_text_key(text): np.asarray(vector, dtype=np.float32) for text, vector in zip(texts, vectors)},
+        k=int(os.getenv("RETRIEVAL_K", 4)),
+        fetch_k=int(os.getenv("RETRIEVAL_FETCH_K", 20)),
+        lambda_mult=float(os.getenv("RETRIEVAL_MMR_LAMBDA", 0.5)),
+        reranker=KeywordReranker() if rerank == "keyword" else None,
+        rerank_weight=float(os.getenv("RETRIEVAL_RERANK_WEIGHT", 0.3)),
+        token_budget=int(token_budget) if token_budget else None,
+        model_name=model_name
+    )
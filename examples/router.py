@@ -0,0 +1,487 @@
+"""
+LangChain多后端路由模块
+
+这个模块提供了一个路由聊天模型，把请求分发到多个配置好的后端(例如多台Ollama主机加DeepSeek)：
+- 根据观测到的延迟(EWMA)、进行中的请求数和错误率为后端打分，错误率会随时间衰减，
+  出过错的后端一段时间后会重新得到流量
+- 熔断器：连续失败的后端会被暂时摘除，冷却后再放行一个试探请求
+- 对冲请求：主后端迟迟没有返回时，向次优后端再发一份请求，取先返回的结果
+- 故障转移：后端出错时透明地切换到下一个后端
+
+没有可对冲的后端时请求直接在调用方线程上执行；需要对冲时才使用线程池，线程数由ROUTER_MAX_WORKERS
+(默认与SERVE_MAX_CONCURRENCY相同)决定，请求提交到线程池时就计入后端的进行中请求数。
+"""
+
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+from .models import WrappedChatModel
+
+# 全局后端池注册表，相同配置的路由模型共享统计信息
+_pools: Dict[str, "BackendPool"] = {}
+_pools_lock = threading.Lock()
+
+def parse_router_backends(spec: Optional[str]) -> List[Dict[str, str]]:
+    """
+    解析路由后端配置
+
+    格式为分号分隔的"模型类型|API地址|模型名称"，例如：
+    ollama|http://10.0.0.1:11434|deepseek-r1:7b;deepseek|https://api.deepseek.com/v1|deepseek-chat
+
+    Args:
+        spec: 配置字符串
+
+    Returns:
+        List: 每个后端的model_kwargs
+    """
+    backends = []
+    if not spec:
+        return backends
+    for item in spec.split(";"):
+        item = item.strip()
+        if not item:
+            continue
+        parts = [part.strip() for part in item.split("|")]
+        if len(parts) != 3 or parts[0] not in ("openai", "deepseek", "ollama"):
+            raise ValueError(f"无效的路由后端配置: '{item}'，应为'模型类型|API地址|模型名称'")
+        backends.append({
+            "model_type": parts[0],
+            "api_base": parts[1],
+            "model_name": parts[2]
+        })
+    return backends
+
+class CircuitBreaker:
+    """
+    熔断器
+
+    连续失败达到阈值后进入打开状态，拒绝请求；冷却时间过后进入半开状态，
+    只放行一个试探请求，成功则关闭，失败则重新打开。
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def available(self) -> bool:
+        """判断当前是否可能接收请求(不占用半开状态的试探名额)"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                return time.monotonic() - self.opened_at >= self.reset_timeout
+            return not self._trial_in_flight
+
+    def acquire(self) -> bool:
+        """在真正发送请求前调用，半开状态下只有一个请求能拿到试探名额"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = "half_open"
+                self._trial_in_flight = False
+            if self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+            self._trial_in_flight = False
+
+    def release(self):
+        """请求被调用方取消、没有结果时释放试探名额，不改变熔断状态"""
+        with self._lock:
+            self._trial_in_flight = False
+
+class Backend:
+    """
+    路由后端
+
+    保存后端的模型实例以及延迟、并发和错误率等统计信息。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        model: BaseChatModel,
+        alpha: float = 0.3,
+        error_half_life: float = 30.0
+    ):
+        self.name = name
+        self.model = model
+        params = model._get_ls_params()
+        self.provider = params.get("ls_provider", "")
+        self.model_name = params.get("ls_model_name", "")
+        self.alpha = alpha
+        self.error_half_life = error_half_life
+        self.ewma_latency: Optional[float] = None
+        self._error_rate = 0.0
+        self._error_updated = time.monotonic()
+        self.in_flight = 0
+        self.requests = 0
+        self.latencies = deque(maxlen=100)
+        self.breaker = CircuitBreaker(
+            failure_threshold=int(os.getenv("ROUTER_FAILURE_THRESHOLD", 3)),
+            reset_timeout=float(os.getenv("ROUTER_RESET_TIMEOUT", 30))
+        )
+        self._lock = threading.Lock()
+
+    @property
+    def error_rate(self) -> float:
+        """按半衰期随时间衰减的错误率，没有流量的后端也会逐渐恢复"""
+        elapsed = time.monotonic() - self._error_updated
+        return self._error_rate * 0.5 ** (elapsed / self.error_half_life)
+
+    def score(self, default_latency: float) -> float:
+        """后端得分，越低越好：延迟越高、排队越多、错误率越高得分越高"""
+        latency = self.ewma_latency if self.ewma_latency is not None else default_latency
+        return latency * (self.in_flight + 1) / max(1.0 - self.error_rate, 0.05)
+
+    def p95(self) -> Optional[float]:
+        """最近请求延迟的P95"""
+        if len(self.latencies) < 5:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def begin(self):
+        with self._lock:
+            self.in_flight += 1
+            self.requests += 1
+
+    def end(self, latency: float, ok: Optional[bool]):
+        """
+        请求结束时更新统计信息
+
+        ok为None表示请求被调用方取消(例如流式输出被提前关闭)，只释放进行中的计数和试探名额。
+        """
+        with self._lock:
+            self.in_flight -= 1
+            if ok is not None:
+                self._error_rate = (1 - self.alpha) * self.error_rate + self.alpha * (0.0 if ok else 1.0)
+                self._error_updated = time.monotonic()
+            if ok:
+                self.latencies.append(latency)
+                if self.ewma_latency is None:
+                    self.ewma_latency = latency
+                else:
+                    self.ewma_latency = (1 - self.alpha) * self.ewma_latency + self.alpha * latency
+        if ok is None:
+            self.breaker.release()
+        elif ok:
+            self.breaker.record_success()
+        else:
+            self.breaker.record_failure()
+
+    def metadata(self) -> Dict[str, str]:
+        """写入响应response_metadata的后端信息，用于识别实际处理请求的后端"""
+        return {
+            "router_backend": self.name,
+            "router_provider": self.provider,
+            "router_model": self.model_name
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ewma_latency": self.ewma_latency,
+            "p95_latency": self.p95(),
+            "error_rate": round(self.error_rate, 4),
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "circuit": self.breaker.state
+        }
+
+class BackendPool:
+    """
+    后端池
+
+    负责挑选后端、执行对冲请求和故障转移。
+    """
+
+    def __init__(
+        self,
+        backends: List[Backend],
+        hedge_delay: Optional[float] = None,
+        max_workers: int = 256
+    ):
+        self.backends = backends
+        self.hedge_delay = hedge_delay
+        self.hedged = 0
+        self.failovers = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="router")
+
+    def ranked(self) -> List[Backend]:
+        """按得分从好到差排列当前允许接收请求的后端"""
+        known = [b.ewma_latency for b in self.backends if b.ewma_latency is not None]
+        # 还没有延迟数据的后端按已知最快的后端计算，保证它们能被尝试到
+        default_latency = min(known) if known else 1.0
+        ranked = sorted(self.backends, key=lambda b: b.score(default_latency))
+        return [b for b in ranked if b.breaker.available()]
+
+    def _hedge_delay(self, backend: Backend) -> Optional[float]:
+        """对冲等待时间：优先使用固定配置，否则使用主后端的P95延迟"""
+        if self.hedge_delay is not None:
+            return self.hedge_delay
+        return backend.p95()
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _submit(self, backend: Backend, fn, exclusive: bool) -> Future:
+        # 提交时就计入进行中的请求，在线程池中排队的请求也会体现在后端得分里
+        backend.begin()
+        try:
+            return self._executor.submit(self._call, backend, fn, exclusive)
+        except BaseException:
+            backend.end(0.0, ok=None)
+            raise
+
+    def _call(self, backend: Backend, fn, exclusive: bool) -> Any:
+        """执行一次请求，调用前需要先调用backend.begin()"""
+        start = time.perf_counter()
+        ok: Optional[bool] = None
+        try:
+            result = fn(backend, exclusive)
+            ok = True
+            return result
+        except Exception:
+            ok = False
+            raise
+        finally:
+            backend.end(time.perf_counter() - start, ok=ok)
+
+    def execute(self, fn) -> Any:
+        """
+        在后端池上执行一次请求
+
+        Args:
+            fn: 接收后端和exclusive并发送请求的函数。exclusive表示发送时没有其他进行中的尝试，
+                只有这样的请求才应该使用调用方的回调，对冲请求不会重复输出token
+
+        Returns:
+            Any: 最先成功返回的结果
+        """
+        candidates = self.ranked()
+        last_error: Optional[Exception] = None
+
+        def next_backend() -> Optional[Backend]:
+            while candidates:
+                backend = candidates.pop(0)
+                if backend.breaker.acquire():
+                    return backend
+            return None
+
+        primary = next_backend()
+        if primary is None:
+            raise RuntimeError("没有可用的路由后端，所有后端都处于熔断状态")
+
+        if not candidates or self._hedge_delay(primary) is None:
+            # 无法对冲时直接在调用方线程上执行，出错时依次切换到下一个后端
+            backend = primary
+            while backend is not None:
+                backend.begin()
+                try:
+                    return self._call(backend, fn, True)
+                except Exception as e:
+                    last_error = e
+                backend = next_backend()
+                if backend is not None:
+                    self._count("failovers")
+            raise last_error
+
+        pending: Dict[Future, Backend] = {}
+
+        def launch(backend: Backend):
+            pending[self._submit(backend, fn, not pending)] = backend
+
+        launch(primary)
+        while pending:
+            delay = self._hedge_delay(primary) if candidates else None
+            done, _ = wait(list(pending), timeout=delay, return_when=FIRST_COMPLETED)
+            if not done:
+                # 主后端超过对冲等待时间仍未返回，向次优后端再发一份请求
+                backend = next_backend()
+                if backend is not None:
+                    self._count("hedged")
+                    launch(backend)
+                continue
+            for future in done:
+                pending.pop(future)
+                try:
+                    # 其余仍在进行的请求在后台完成，只用于更新统计信息
+                    return future.result()
+                except Exception as e:
+                    last_error = e
+                    backend = next_backend()
+                    if backend is not None:
+                        self._count("failovers")
+                        launch(backend)
+
+        raise last_error
+
+    def stream(self, fn) -> Iterator[Any]:
+        """
+        在后端池上执行一次流式请求
+
+        只有在收到第一个分块之前出错时才会故障转移，已经开始输出的流不能切换后端。
+        fn接收后端并返回分块迭代器。
+        """
+        last_error: Optional[Exception] = None
+        for backend in self.ranked():
+            if not backend.breaker.acquire():
+                continue
+            backend.begin()
+            start = time.perf_counter()
+            started = False
+            ok: Optional[bool] = None
+            try:
+                for chunk in fn(backend):
+                    started = True
+                    yield chunk
+                ok = True
+            except Exception as e:
+                ok = False
+                if started:
+                    raise
+                last_error = e
+                self._count("failovers")
+                continue
+            finally:
+                # 调用方提前停止读取(GeneratorExit)时ok为None，既不算成功也不算失败
+                backend.end(time.perf_counter() - start, ok=ok)
+            return
+
+        if last_error is not None:
+            raise last_error
+        raise RuntimeError("没有可用的路由后端，所有后端都处于熔断状态")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hedged": self.hedged,
+            "failovers": self.failovers,
+            "backends": {b.name: b.stats() for b in self.backends}
+        }
+
+class RouterChatModel(WrappedChatModel):
+    """
+    多后端路由聊天模型
+
+    inner是第一个后端的模型，只用于把工具转换成提供商格式；实际请求由后端池分发。
+    请求开始时提供商报告为router，实际处理请求的后端写在响应的response_metadata中。
+    """
+
+    pool: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return "router"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return {"router_backends": [backend.name for backend in self.pool.backends]}
+
+    def _get_ls_params(self, stop: Optional[List[str]] = None, **kwargs: Any):
+        params = self.inner._get_ls_params(stop=stop, **kwargs)
+        params.update(ls_provider="router", ls_model_name="router")
+        return params
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        def attempt(backend: Backend, exclusive: bool) -> ChatResult:
+            result = backend.model._generate(
+                messages,
+                stop=stop,
+                run_manager=run_manager if exclusive else None,
+                **kwargs
+            )
+            for generation in result.generations:
+                generation.message.response_metadata.update(backend.metadata())
+            return result
+
+        return self.pool.execute(attempt)
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        def attempt(backend: Backend) -> Iterator[ChatGenerationChunk]:
+            yield from backend.model._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+            # 最后追加一个只带后端信息的空分块，合并后的消息可以看到实际处理请求的后端
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", response_metadata=backend.metadata()))
+
+        yield from self.pool.stream(attempt)
+
+def get_router_model(spec: str, build_model) -> RouterChatModel:
+    """
+    获取路由聊天模型
+
+    Args:
+        spec: ROUTER_BACKENDS配置字符串
+        build_model: 根据后端的model_kwargs创建模型实例的函数
+
+    Returns:
+        RouterChatModel: 路由聊天模型
+    """
+    with _pools_lock:
+        if spec not in _pools:
+            half_life = float(os.getenv("ROUTER_ERROR_HALF_LIFE", 30))
+            backends = [
+                Backend(
+                    f"{kwargs['model_type']}@{kwargs['api_base']}/{kwargs['model_name']}",
+                    build_model(kwargs),
+                    error_half_life=half_life
+                )
+                for kwargs in parse_router_backends(spec)
+            ]
+            if not backends:
+                raise ValueError("ROUTER_BACKENDS中没有配置任何后端")
+            hedge_delay = os.getenv("ROUTER_HEDGE_DELAY_MS")
+            _pools[spec] = BackendPool(
+                backends,
+                hedge_delay=float(hedge_delay) / 1000 if hedge_delay else None,
+                max_workers=int(os.getenv("ROUTER_MAX_WORKERS", os.getenv("SERVE_MAX_CONCURRENCY", 256)))
+            )
+        pool = _pools[spec]
+    return RouterChatModel(inner=pool.backends[0].model, pool=pool)
+
+def get_router_stats() -> Dict[str, Any]:
+    """返回所有路由后端池的统计信息"""
+    with _pools_lock:
+        return {spec: pool.stats() for spec, pool in _pools.items()}
@@ -0,0 +1,313 @@
+"""
+LangChain请求调度模块
+
+这个模块在聊天模型和嵌入模型前面加了一层请求调度器：
+- 单飞(single-flight)：相同的并发请求只发送一次，其余调用方共享结果
+- 微批处理：嵌入查询在很短的时间窗口内收集起来，通过一次批量请求发送
+- 并发限制：遵守后端的并行请求上限(例如Ollama的OLLAMA_NUM_PARALLEL)
+
+聊天接口没有批量调用，聊天请求不经过时间窗口，只做单飞合并和并发限制，避免白白增加延迟。
+"""
+
+import os
+import json
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from langchain_core.callbacks import CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import BaseMessage, messages_to_dict
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+from .models import WrappedChatModel
+
+# 全局调度器注册表，同一个后端/模型的所有调用方共享一个调度器
+_schedulers: Dict[Tuple[str, str], "RequestScheduler"] = {}
+_embedding_batchers: Dict[Tuple[str, str, str], "MicroBatcher"] = {}
+_registry_lock = threading.Lock()
+
+class SingleFlight:
+    """
+    单飞执行器
+
+    同一个key同时只会执行一次，在此期间到达的相同请求会等待并共享第一次执行的结果。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, Future] = {}
+        self.coalesced = 0
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        执行fn或等待正在进行的相同调用
+
+        Returns:
+            Tuple: (结果, 是否复用了其他调用方的结果)
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                future = Future()
+                self._calls[key] = future
+                leader = True
+
+        if not leader:
+            return future.result(), True
+
+        try:
+            result = fn()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+class MicroBatcher:
+    """
+    微批处理器
+
+    第一个到达的请求成为"领队"，等待一个很短的时间窗口(或批次已满)，
+    然后把窗口内收集到的所有请求交给batch_fn一次性处理。
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[List[Any]], List[Any]],
+        window: float = 0.01,
+        max_batch_size: int = 16
+    ):
+        self.batch_fn = batch_fn
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[Any, Future]] = []
+        self._full = threading.Event()
+        self.batches = 0
+        self.items = 0
+
+    def submit(self, item: Any) -> Any:
+        """提交一个请求并阻塞等待其结果"""
+        future = Future()
+        with self._lock:
+            self._pending.append((item, future))
+            leader = len(self._pending) == 1
+            if len(self._pending) >= self.max_batch_size:
+                self._full.set()
+
+        if leader:
+            self._full.wait(self.window)
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._full.clear()
+                # 计数和_pending一起在锁内更新，多个领队并发时统计也准确
+                self.batches += -(-len(batch) // self.max_batch_size)
+                self.items += len(batch)
+            for start in range(0, len(batch), self.max_batch_size):
+                self._run(batch[start:start + self.max_batch_size])
+
+        return future.result()
+
+    def _run(self, batch: List[Tuple[Any, Future]]):
+        """执行一个批次，并把结果(或异常)分发给各个调用方"""
+        try:
+            results = self.batch_fn([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        """返回批处理统计信息"""
+        with self._lock:
+            return {"batches": self.batches, "items": self.items}
+
+class RequestScheduler:
+    """
+    单个后端模型的请求调度器
+
+    组合了单飞合并和并发上限，统计信息可以通过stats()查看。
+    """
+
+    def __init__(self, max_concurrency: int = 16):
+        self.max_concurrency = max_concurrency
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._single_flight = SingleFlight()
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def _call(self, fn: Callable[[], Any]) -> Any:
+        """在并发上限内执行一次后端调用"""
+        with self._slots:
+            return fn()
+
+    def submit(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        通过调度器执行一次请求
+
+        Args:
+            key: 请求的唯一标识，相同key的并发请求会被合并
+            fn: 实际发送请求的函数
+
+        Returns:
+            Tuple: (结果, 是否复用了其他调用方的结果)
+        """
+        with self._lock:
+            self.requests += 1
+        return self._single_flight.do(key, lambda: self._call(fn))
+
+    def slot(self) -> threading.BoundedSemaphore:
+        """返回并发槽位，供流式请求等无法批处理的调用使用"""
+        return self._slots
+
+    def stats(self) -> Dict[str, Any]:
+        """返回调度统计信息"""
+        with self._lock:
+            requests = self.requests
+        return {
+            "requests": requests,
+            "coalesced": self._single_flight.coalesced,
+            "max_concurrency": self.max_concurrency
+        }
+
+def _max_concurrency(model_type: str) -> int:
+    """根据后端类型确定并发上限，Ollama遵守服务端的并行请求数"""
+    if model_type == "ollama":
+        return int(os.getenv("OLLAMA_NUM_PARALLEL", 4))
+    return int(os.getenv("SCHEDULER_MAX_CONCURRENCY", 16))
+
+def get_scheduler(model_type: str, model_name: Optional[str]) -> RequestScheduler:
+    """
+    获取(或创建)指定后端模型共享的请求调度器
+
+    Args:
+        model_type: 模型类型
+        model_name: 模型名称
+
+    Returns:
+        RequestScheduler: 请求调度器
+    """
+    key = (model_type, model_name or "")
+    with _registry_lock:
+        if key not in _schedulers:
+            _schedulers[key] = RequestScheduler(max_concurrency=_max_concurrency(model_type))
+        return _schedulers[key]
+
+def get_embedding_batcher(
+    model_type: str,
+    api_base: Optional[str],
+    model_name: Optional[str],
+    embeddings: Embeddings
+) -> MicroBatcher:
+    """
+    获取(或创建)指定嵌入模型共享的微批处理器
+
+    窗口内的所有查询会去重后通过一次embed_documents调用发送。批处理器按后端类型、
+    API地址和嵌入模型区分，同一个key的嵌入模型实例配置相同，复用第一个实例即可。
+    """
+    key = (model_type, api_base or "", model_name or "")
+    with _registry_lock:
+        if key not in _embedding_batchers:
+            def embed_batch(texts: List[str]) -> List[List[float]]:
+                unique = list(dict.fromkeys(texts))
+                vectors = dict(zip(unique, embeddings.embed_documents(unique)))
+                return [vectors[text] for text in texts]
+
+            _embedding_batchers[key] = MicroBatcher(
+                embed_batch,
+                window=float(os.getenv("SCHEDULER_BATCH_WINDOW_MS", 10)) / 1000,
+                max_batch_size=int(os.getenv("SCHEDULER_MAX_BATCH_SIZE", 64))
+            )
+        return _embedding_batchers[key]
+
+def get_scheduler_stats() -> Dict[str, Dict[str, Any]]:
+    """返回所有调度器的统计信息"""
+    with _registry_lock:
+        return {f"{t}:{m}": s.stats() for (t, m), s in _schedulers.items()}
+
+class ScheduledChatModel(WrappedChatModel):
+    """
+    经过请求调度器的聊天模型
+
+    非流式请求会经过单飞合并，所有请求都受并发上限约束。
+    """
+
+    scheduler: Any
+
+    @property
+    def _llm_type(self) -> str:
+        return f"scheduled-{self.inner._llm_type}"
+
+    def _request_key(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]],
+        kwargs: Dict[str, Any]
+    ) -> str:
+        """把请求序列化为稳定的key，用于识别相同的请求"""
+        return json.dumps(
+            {
+                "messages": messages_to_dict(messages),
+                "stop": stop,
+                "kwargs": kwargs
+            },
+            sort_keys=True,
+            ensure_ascii=False,
+            default=str
+        )
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        key = self._request_key(messages, stop, kwargs)
+        result, shared = self.scheduler.submit(
+            key,
+            # 回调只挂在实际发送请求的调用上，复用结果的调用方不会重复记录用量
+            lambda: self.inner._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        )
+        # 复用的结果需要复制一份，避免调用方之间互相修改消息对象
+        return result.model_copy(deep=True) if shared else result
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Optional[CallbackManagerForLLMRun] = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        with self.scheduler.slot():
+            yield from self.inner._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+class BatchedEmbeddings(Embeddings):
+    """
+    经过微批处理的嵌入模型
+
+    并发的embed_query调用会合并成一次embed_documents批量请求。
+    """
+
+    def __init__(self, inner: Embeddings, batcher: MicroBatcher):
+        self.inner = inner
+        self.batcher = batcher
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.inner.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.batcher.submit(text)
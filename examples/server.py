@@ -0,0 +1,479 @@
+"""
+LangChain异步服务模块
+
+这个模块基于asyncio提供一个常驻的本地HTTP服务，把聊天、链、记忆和代理流水线以HTTP/SSE接口暴露出来。
+模型、链和检索索引在启动时创建并预热，所有请求共享，避免每次调用都付出解释器启动、
+LangChain导入和客户端构建的开销。
+
+接口:
+- GET  /health              健康检查
+- GET  /metrics             Prometheus指标(需要开启埋点)
+- POST /chat                {"input": "...", "system": "...", "stream": false}
+- POST /chain               {"topic": "...", "stream": false}
+- POST /memory              {"session_id": "...", "input": "...", "stream": false}
+- POST /agent               {"input": "...", "chat_history": [["human", "..."], ["ai", "..."]]}
+- POST /rag                 与/agent相同，使用检索增强代理
+
+请求体中"stream": true时以SSE返回: 每个分块为`data: {"token": "..."}`，结束时发送`event: end`。
+
+模型客户端是同步实现，LangChain的ainvoke/astream会把调用放到事件循环的默认线程池中执行。
+服务启动时把默认线程池的大小设为SERVE_MAX_CONCURRENCY，使并发上限真正由这个配置决定。
+超时的请求会立即返回504，但已经在线程中执行的模型调用无法中断，会继续运行到结束并占用一个线程。
+"""
+
+import os
+import json
+import time
+import signal
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+
+from .accounting import TokenBudgetExceeded, usage_scope
+from .models import get_chat_model
+from .prompts import get_chain
+from .telemetry import get_tracer, telemetry_enabled
+
+_MAX_HEADER_BYTES = 64 * 1024
+_MAX_BODY_BYTES = 1024 * 1024
+_STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+    504: "Gateway Timeout"
+}
+
+class HttpError(Exception):
+    """带HTTP状态码的请求错误"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+class Request:
+    """解析后的HTTP请求"""
+
+    def __init__(self, method: str, path: str, headers: Dict[str, str], body: bytes):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+
+    def json(self) -> Dict[str, Any]:
+        if not self.body:
+            return {}
+        try:
+            data = json.loads(self.body)
+        except ValueError:
+            raise HttpError(400, "请求体不是有效的JSON")
+        if not isinstance(data, dict):
+            raise HttpError(400, "请求体必须是JSON对象")
+        return data
+
+    @property
+    def keep_alive(self) -> bool:
+        return self.headers.get("connection", "").lower() != "close"
+
+class Pipelines:
+    """
+    启动时构建一次、所有请求共享的流水线
+    """
+
+    def __init__(self, model_kwargs: Optional[Dict[str, Any]] = None, max_sessions: int = 1000):
+        self.model_kwargs = model_kwargs
+        self.max_sessions = max_sessions
+        self.sessions: "OrderedDict[str, List[BaseMessage]]" = OrderedDict()
+        self.agent = None
+        self.rag_agent = None
+        self.rag_error: Optional[str] = None
+
+    def build(self):
+        """创建模型、链和代理，并构建检索索引"""
+        self.model = get_chat_model(self.model_kwargs)
+        self.chain = get_chain("chain.facts", self.model_kwargs)
+        self.memory_chain = get_chain("memory.conversation", self.model_kwargs)
+
+        from .agents import create_basic_agent_executor, create_retrieval_agent_executor
+        self.agent = create_basic_agent_executor(self.model_kwargs, verbose=False)
+        try:
+            self.rag_agent = create_retrieval_agent_executor(self.model_kwargs, verbose=False)
+        except Exception as e:
+            # 嵌入模型不可用时，其余接口照常提供服务
+            self.rag_error = str(e)
+            print(f"警告: 检索代理初始化失败，/rag接口不可用: {self.rag_error}")
+
+    async def warmup(self):
+        """发送一次预热请求，提前建立连接并让本地模型加载到内存中"""
+        start = time.perf_counter()
+        try:
+            await self.model.ainvoke([HumanMessage(content="你好")])
+            print(f"模型预热完成，耗时{time.perf_counter() - start:.2f}秒")
+        except Exception as e:
+            print(f"警告: 模型预热失败: {str(e)}")
+
+    def history(self, session_id: str) -> List[BaseMessage]:
+        """获取会话历史，超过上限时淘汰最久未使用的会话"""
+        if session_id in self.sessions:
+            self.sessions.move_to_end(session_id)
+        else:
+            self.sessions[session_id] = []
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return self.sessions[session_id]
+
+def _require(data: Dict[str, Any], key: str) -> str:
+    value = data.get(key)
+    if not isinstance(value, str) or not value:
+        raise HttpError(400, f"缺少字段: {key}")
+    return value
+
+def _parse_history(items: Any) -> List[BaseMessage]:
+    """把[["human", "..."], ["ai", "..."]]格式的对话历史转换成消息列表"""
+    messages = []
+    for item in items or []:
+        if not isinstance(item, (list, tuple)) or len(item) != 2:
+            raise HttpError(400, "chat_history的每一项必须是[角色, 内容]")
+        role, content = item
+        messages.append(HumanMessage(content=content) if role == "human" else AIMessage(content=content))
+    return messages
+
+class Server:
+    """
+    基于asyncio的HTTP/SSE服务
+    """
+
+    def __init__(
+        self,
+        pipelines: Pipelines,
+        max_concurrency: int = 256,
+        request_timeout: float = 120.0,
+        idle_timeout: float = 30.0,
+        shutdown_grace: float = 10.0
+    ):
+        self.pipelines = pipelines
+        self.request_timeout = request_timeout
+        self.idle_timeout = idle_timeout
+        self.shutdown_grace = shutdown_grace
+        self._slots = asyncio.Semaphore(max_concurrency)
+        self._connections: set = set()
+        self._active_requests = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._shutting_down = False
+        self.routes = {
+            "/chat": self.handle_chat,
+            "/chain": self.handle_chain,
+            "/memory": self.handle_memory,
+            "/agent": self.handle_agent,
+            "/rag": self.handle_rag
+        }
+
+    async def handle_chat(self, data: Dict[str, Any]) -> Tuple[Any, Optional[AsyncIterator[str]]]:
+        messages = []
+        if data.get("system"):
+            messages.append(SystemMessage(content=data["system"]))
+        messages.append(HumanMessage(content=_require(data, "input")))
+        if data.get("stream"):
+            return None, self._tokens(self.pipelines.model.astream(messages))
+        response = await self.pipelines.model.ainvoke(messages)
+        return {"output": response.content}, None
+
+    async def handle_chain(self, data: Dict[str, Any]):
+        inputs = {"topic": _require(data, "topic")}
+        if data.get("stream"):
+            return None, self.pipelines.chain.astream(inputs)
+        return {"output": await self.pipelines.chain.ainvoke(inputs)}, None
+
+    async def handle_memory(self, data: Dict[str, Any]):
+        session_id = _require(data, "session_id")
+        question = _require(data, "input")
+        history = self.pipelines.history(session_id)
+        inputs = {"history": list(history), "input": question}
+
+        def remember(answer: str):
+            history.append(HumanMessage(content=question))
+            history.append(AIMessage(content=answer))
+
+        if data.get("stream"):
+            async def stream():
+                parts = []
+                async for token in self.pipelines.memory_chain.astream(inputs):
+                    parts.append(token)
+                    yield token
+                remember("".join(parts))
+            return None, stream()
+
+        answer = await self.pipelines.memory_chain.ainvoke(inputs)
+        remember(answer)
+        return {"output": answer, "session_id": session_id}, None
+
+    async def handle_agent(self, data: Dict[str, Any]):
+        response = await self.pipelines.agent.ainvoke({
+            "input": _require(data, "input"),
+            "chat_history": _parse_history(data.get("chat_history"))
+        })
+        return {"output": response["output"]}, None
+
+    async def handle_rag(self, data: Dict[str, Any]):
+        if self.pipelines.rag_agent is None:
+            raise HttpError(503, f"检索代理不可用: {self.pipelines.rag_error}")
+        response = await self.pipelines.rag_agent.ainvoke({
+            "input": _require(data, "input"),
+            "chat_history": _parse_history(data.get("chat_history"))
+        })
+        return {"output": response["output"]}, None
+
+    @staticmethod
+    async def _tokens(chunks) -> AsyncIterator[str]:
+        async for chunk in chunks:
+            yield chunk.content
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Request]:
+        """读取一个HTTP请求，连接关闭时返回None"""
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.idle_timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+            return None
+        except asyncio.LimitOverrunError:
+            raise HttpError(413, "请求头过大")
+
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, path, _ = lines[0].split(" ", 2)
+        except ValueError:
+            raise HttpError(400, "无效的请求行")
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length", 0) or 0)
+        except ValueError:
+            raise HttpError(400, "无效的Content-Length")
+        if length < 0:
+            raise HttpError(400, "无效的Content-Length")
+        if length > _MAX_BODY_BYTES:
+            raise HttpError(413, "请求体过大")
+        try:
+            body = await reader.readexactly(length) if length else b""
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # 客户端在请求体发送完之前断开了连接
+            return None
+        return Request(method.upper(), path.split("?", 1)[0], headers, body)
+
+    @staticmethod
+    async def _write_response(
+        writer: asyncio.StreamWriter,
+        status: int,
+        body: bytes,
+        content_type: str = "application/json; charset=utf-8",
+        keep_alive: bool = True
+    ):
+        head = (
+            f"HTTP/1.1 {status} {_STATUS_TEXT.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode("latin-1") + body)
+        await writer.drain()
+
+    async def _write_json(self, writer, status: int, payload: Any, keep_alive: bool = True):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        await self._write_response(writer, status, body, keep_alive=keep_alive)
+
+    async def _write_sse(self, writer: asyncio.StreamWriter, stream: AsyncIterator[str]):
+        """以SSE格式输出流式结果，整个流共享同一个请求超时"""
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream; charset=utf-8\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        await writer.drain()
+        try:
+            async for token in stream:
+                if not token:
+                    # 提供商和路由模型会产生只带元数据的空分块
+                    continue
+                payload = json.dumps({"token": token}, ensure_ascii=False)
+                writer.write(f"data: {payload}\n\n".encode("utf-8"))
+                await writer.drain()
+            writer.write(b"event: end\ndata: {}\n\n")
+        except Exception as e:
+            payload = json.dumps({"error": str(e)}, ensure_ascii=False)
+            writer.write(f"event: error\ndata: {payload}\n\n".encode("utf-8"))
+        await writer.drain()
+
+    async def _dispatch(self, request: Request, writer: asyncio.StreamWriter) -> bool:
+        """处理一个请求，返回连接是否可以继续复用"""
+        if request.method == "GET" and request.path == "/health":
+            await self._write_json(writer, 200, {"status": "ok"}, request.keep_alive)
+            return request.keep_alive
+        if request.method == "GET" and request.path == "/metrics":
+            if not telemetry_enabled():
+                raise HttpError(404, "未开启埋点(TELEMETRY_ENABLED)")
+            body = get_tracer().render_prometheus().encode("utf-8")
+            await self._write_response(
+                writer, 200, body, "text/plain; version=0.0.4; charset=utf-8", request.keep_alive
+            )
+            return request.keep_alive
+
+        handler = self.routes.get(request.path)
+        if handler is None:
+            raise HttpError(404, f"未知的接口: {request.path}")
+        if request.method != "POST":
+            raise HttpError(405, "只支持POST请求")
+        if self._shutting_down:
+            raise HttpError(503, "服务正在关闭")
+
+        tracer = get_tracer() if telemetry_enabled() else None
+        request_span = tracer.start(f"POST {request.path}", "server") if tracer else None
+        error = None
+        try:
+            data = request.json()
+            # token用量和会话预算按请求中的session_id统计
+            with usage_scope(session=str(data.get("session_id") or "default")):
+                async with self._slots:
+                    result, stream = await asyncio.wait_for(handler(data), self.request_timeout)
+                    if stream is not None:
+                        try:
+                            await asyncio.wait_for(self._write_sse(writer, stream), self.request_timeout)
+                        except asyncio.TimeoutError:
+                            # 响应头已经发出，只能通过SSE事件告知超时
+                            writer.write(b'event: error\ndata: {"error": "timeout"}\n\n')
+                            await writer.drain()
+                        return False
+            await self._write_json(writer, 200, result, request.keep_alive)
+            return request.keep_alive
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            if request_span is not None:
+                tracer.end(request_span, error if isinstance(error, Exception) else None)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """处理一个TCP连接上的所有请求(支持HTTP/1.1长连接)"""
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            keep_alive = True
+            while keep_alive and not self._shutting_down:
+                try:
+                    request = await self._read_request(reader)
+                except HttpError as e:
+                    await self._write_json(writer, e.status, {"error": str(e)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+
+                self._active_requests += 1
+                self._idle.clear()
+                try:
+                    keep_alive = await self._dispatch(request, writer)
+                except HttpError as e:
+                    await self._write_json(writer, e.status, {"error": str(e)}, request.keep_alive)
+                    keep_alive = request.keep_alive
+                except asyncio.TimeoutError:
+                    await self._write_json(writer, 504, {"error": "请求超时"}, keep_alive=False)
+                    keep_alive = False
+                except TokenBudgetExceeded as e:
+                    await self._write_json(writer, 429, {"error": str(e)}, request.keep_alive)
+                    keep_alive = request.keep_alive
+                except (ConnectionError, asyncio.CancelledError):
+                    raise
+                except Exception as e:
+                    await self._write_json(writer, 500, {"error": str(e)}, keep_alive=False)
+                    keep_alive = False
+                finally:
+                    self._active_requests -= 1
+                    if self._active_requests == 0:
+                        self._idle.set()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def run(self, host: str, port: int):
+        """启动服务，收到SIGINT/SIGTERM后优雅关闭"""
+        server = await asyncio.start_server(
+            self.handle_connection, host, port, limit=_MAX_HEADER_BYTES, backlog=1024
+        )
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                # Windows不支持add_signal_handler，依赖KeyboardInterrupt退出
+                pass
+
+        print(f"服务已启动: http://{host}:{port}")
+        async with server:
+            await stop.wait()
+            print("\n正在关闭服务，等待进行中的请求完成...")
+            self._shutting_down = True
+            server.close()
+            await server.wait_closed()
+            try:
+                await asyncio.wait_for(self._idle.wait(), self.shutdown_grace)
+            except asyncio.TimeoutError:
+                print(f"仍有{self._active_requests}个请求未完成，强制关闭")
+            for task in list(self._connections):
+                task.cancel()
+            if self._connections:
+                await asyncio.gather(*self._connections, return_exceptions=True)
+        print("服务已关闭")
+
+def serve(host: str = "127.0.0.1", port: int = 8000, model_kwargs: Optional[Dict[str, Any]] = None):
+    """
+    启动常驻的异步服务
+
+    Args:
+        host: 监听地址
+        port: 监听端口
+        model_kwargs: 可选的模型参数，包括model_type和model_name
+    """
+    print("正在初始化模型和流水线...")
+    start = time.perf_counter()
+    pipelines = Pipelines(model_kwargs, max_sessions=int(os.getenv("SERVE_MAX_SESSIONS", 1000)))
+    pipelines.build()
+    print(f"流水线初始化完成，耗时{time.perf_counter() - start:.2f}秒")
+
+    max_concurrency = int(os.getenv("SERVE_MAX_CONCURRENCY", 256))
+    server = Server(
+        pipelines,
+        max_concurrency=max_concurrency,
+        request_timeout=float(os.getenv("SERVE_REQUEST_TIMEOUT", 120)),
+        shutdown_grace=float(os.getenv("SERVE_SHUTDOWN_GRACE", 10))
+    )
+
+    async def main():
+        # 同步模型调用在默认线程池中执行，线程数与并发上限一致(包括预热请求)
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="serve")
+        )
+        if os.getenv("SERVE_WARMUP", "true").strip().lower() in ("1", "true", "yes", "on"):
+            await pipelines.warmup()
+        await server.run(host, port)
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
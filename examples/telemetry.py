@@ -0,0 +1,577 @@
+"""
+LangChain运行时埋点模块
+
+这个模块基于LangChain的回调机制记录调用链路上每一段的耗时(span)：
+提示模板格式化、模型调用、首token时间、输出解析、工具调用、检索以及记忆的加载和保存，
+同时统计输入和输出的token数。
+
+数据可以导出到本地JSON Lines文件或OTLP/JSON文件，指标可以通过Prometheus文本格式的HTTP端点抓取。
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import atexit
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from uuid import UUID
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.outputs import LLMResult
+from langchain_core.tracers.context import register_configure_hook
+
+# 耗时直方图的桶边界(秒)
+_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 当前上下文使用的回调处理器，设置后所有LangChain运行都会自动带上它
+_handler_var: ContextVar[Optional["TracingCallbackHandler"]] = ContextVar(
+    "langchain_demo_tracing", default=None
+)
+register_configure_hook(_handler_var, inheritable=True)
+
+_tracer: Optional["Tracer"] = None
+_tracer_lock = threading.Lock()
+
+class Span:
+    """一段被记录的操作，字段与OpenTelemetry的span保持一致"""
+
+    def __init__(
+        self,
+        name: str,
+        kind: str,
+        trace_id: str,
+        parent_id: Optional[str] = None,
+        attributes: Optional[Dict[str, Any]] = None
+    ):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.status = "ok"
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        """耗时(秒)"""
+        end = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end - self.start_ns) / 1e9
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round(self.duration * 1000, 3),
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes
+        }
+
+class JsonFileExporter:
+    """
+    把span以JSON Lines格式追加写入本地文件
+
+    export只把span放进队列，由后台线程定期批量序列化并写入，请求路径上没有文件I/O；
+    进程退出时会写入剩余的span。
+    """
+
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._queue: "queue.SimpleQueue[Span]" = queue.SimpleQueue()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        threading.Thread(target=self._run, name="span-exporter", daemon=True).start()
+        atexit.register(self.flush)
+
+    def _format(self, span: Span) -> str:
+        return json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+
+    def export(self, span: Span):
+        self._queue.put(span)
+
+    def flush(self):
+        """把队列中的span写入文件"""
+        with self._lock:
+            lines = []
+            while True:
+                try:
+                    lines.append(self._format(self._queue.get_nowait()))
+                except queue.Empty:
+                    break
+            if lines:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write("\n".join(lines) + "\n")
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"导出span时出错: {str(e)}")
+
+class OtlpJsonFileExporter(JsonFileExporter):
+    """把span按OTLP/JSON格式(每行一个ExportTraceServiceRequest)写入本地文件"""
+
+    @staticmethod
+    def _value(value: Any) -> Dict[str, Any]:
+        if isinstance(value, bool):
+            return {"boolValue": value}
+        if isinstance(value, int):
+            return {"intValue": str(value)}
+        if isinstance(value, float):
+            return {"doubleValue": value}
+        return {"stringValue": str(value)}
+
+    def _format(self, span: Span) -> str:
+        attributes = dict(span.attributes, **{"langchain.kind": span.kind})
+        otlp_span = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [{"key": k, "value": self._value(v)} for k, v in attributes.items()],
+            "status": {"code": 2, "message": span.error or ""} if span.status == "error" else {"code": 1}
+        }
+        if span.parent_id:
+            otlp_span["parentSpanId"] = span.parent_id
+        request = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "langchaindemo"}}]},
+                "scopeSpans": [{"scope": {"name": "examples.telemetry"}, "spans": [otlp_span]}]
+            }]
+        }
+        return json.dumps(request, ensure_ascii=False)
+
+class Histogram:
+    """累积型直方图，输出格式与Prometheus一致"""
+
+    def __init__(self):
+        self.counts = [0] * len(_BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.total += value
+        self.count += 1
+        for i, bound in enumerate(_BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+
+class Tracer:
+    """
+    span收集器
+
+    保存最近的span，把结束的span交给导出器，并汇总成Prometheus指标。
+    """
+
+    def __init__(self, exporters: Optional[List[Any]] = None, max_spans: int = 10000):
+        self.exporters = exporters or []
+        self.spans = deque(maxlen=max_spans)
+        self.durations: Dict[Tuple[str, str], Histogram] = defaultdict(Histogram)
+        self.ttft: Dict[str, Histogram] = defaultdict(Histogram)
+        self.tokens: Dict[Tuple[str, str], int] = defaultdict(int)
+        self.errors: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self) -> List[Span]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self) -> Optional[Span]:
+        """当前线程上最内层的span"""
+        stack = self._stack()
+        return stack[-1] if stack else None
+
+    def start(self, name: str, kind: str, parent: Optional[Span] = None, **attributes) -> Span:
+        """开始一个span；不指定parent时使用当前线程上最内层的span"""
+        parent = parent or self.current()
+        return Span(
+            name,
+            kind,
+            trace_id=parent.trace_id if parent else uuid.uuid4().hex,
+            parent_id=parent.span_id if parent else None,
+            attributes=attributes
+        )
+
+    def end(self, span: Span, error: Optional[BaseException] = None):
+        """结束span，更新指标并导出"""
+        span.end_ns = time.time_ns()
+        if error is not None:
+            span.status = "error"
+            span.error = f"{type(error).__name__}: {error}"
+        with self._lock:
+            self.spans.append(span)
+            self.durations[(span.kind, span.name)].observe(span.duration)
+            if error is not None:
+                self.errors[(span.kind, span.name)] += 1
+            if "ttft_ms" in span.attributes:
+                self.ttft[span.attributes.get("model", span.name)].observe(span.attributes["ttft_ms"] / 1000)
+            for direction in ("input", "output"):
+                count = span.attributes.get(f"tokens.{direction}")
+                if count:
+                    self.tokens[(span.attributes.get("model", span.name), direction)] += count
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception as e:
+                print(f"导出span时出错: {str(e)}")
+
+    @contextmanager
+    def span(self, name: str, kind: str = "internal", **attributes) -> Iterator[Span]:
+        """以上下文管理器的方式记录一段操作"""
+        current = self.start(name, kind, **attributes)
+        stack = self._stack()
+        stack.append(current)
+        error = None
+        try:
+            yield current
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            stack.pop()
+            self.end(current, error)
+
+    def render_prometheus(self) -> str:
+        """把汇总指标渲染成Prometheus文本格式"""
+        lines = [
+            "# HELP langchain_span_duration_seconds Duration of traced LangChain operations.",
+            "# TYPE langchain_span_duration_seconds histogram"
+        ]
+        with self._lock:
+            for (kind, name), hist in sorted(self.durations.items()):
+                lines.extend(self._histogram_lines(
+                    "langchain_span_duration_seconds", f'kind="{kind}",name="{_escape(name)}"', hist
+                ))
+            lines.append("# HELP langchain_time_to_first_token_seconds Time to first streamed token.")
+            lines.append("# TYPE langchain_time_to_first_token_seconds histogram")
+            for model, hist in sorted(self.ttft.items()):
+                lines.extend(self._histogram_lines(
+                    "langchain_time_to_first_token_seconds", f'model="{_escape(model)}"', hist
+                ))
+            lines.append("# HELP langchain_tokens_total Tokens sent to and received from models.")
+            lines.append("# TYPE langchain_tokens_total counter")
+            for (model, direction), count in sorted(self.tokens.items()):
+                lines.append(f'langchain_tokens_total{{model="{_escape(model)}",direction="{direction}"}} {count}')
+            lines.append("# HELP langchain_span_errors_total Failed LangChain operations.")
+            lines.append("# TYPE langchain_span_errors_total counter")
+            for (kind, name), count in sorted(self.errors.items()):
+                lines.append(f'langchain_span_errors_total{{kind="{kind}",name="{_escape(name)}"}} {count}')
+        lines.extend(_rate_limit_lines())
+        lines.extend(_cascade_lines())
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _histogram_lines(metric: str, labels: str, hist: Histogram) -> List[str]:
+        lines = [
+            f'{metric}_bucket{{{labels},le="{bound}"}} {count}'
+            for bound, count in zip(_BUCKETS, hist.counts)
+        ]
+        lines.append(f'{metric}_bucket{{{labels},le="+Inf"}} {hist.count}')
+        lines.append(f"{metric}_sum{{{labels}}} {hist.total}")
+        lines.append(f"{metric}_count{{{labels}}} {hist.count}")
+        return lines
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+def _rate_limit_lines() -> List[str]:
+    """如果启用了客户端限流，附带输出排队深度和等待时间"""
+    if "examples.rate_limit" not in sys.modules:
+        return []
+    stats = sys.modules["examples.rate_limit"].get_rate_limit_stats()
+    lines = [
+        "# HELP langchain_rate_limit_queue_depth Requests waiting on the client-side rate limiter.",
+        "# TYPE langchain_rate_limit_queue_depth gauge"
+    ]
+    for backend, values in stats.items():
+        lines.append(f'langchain_rate_limit_queue_depth{{backend="{_escape(backend)}"}} {values["queue_depth"]}')
+    lines.append("# HELP langchain_rate_limit_avg_wait_seconds Average client-side rate limiter wait.")
+    lines.append("# TYPE langchain_rate_limit_avg_wait_seconds gauge")
+    for backend, values in stats.items():
+        lines.append(f'langchain_rate_limit_avg_wait_seconds{{backend="{_escape(backend)}"}} {values["avg_wait"]}')
+    return lines
+
+def _cascade_lines() -> List[str]:
+    """如果使用了级联模型，附带输出每条路由的升级率和节省的时间"""
+    if "examples.cascade" not in sys.modules:
+        return []
+    stats = sys.modules["examples.cascade"].get_cascade_stats()
+    lines = [
+        "# HELP langchain_cascade_escalation_ratio Fraction of cascade requests escalated past the first tier.",
+        "# TYPE langchain_cascade_escalation_ratio gauge"
+    ]
+    for route, values in stats.items():
+        lines.append(f'langchain_cascade_escalation_ratio{{route="{_escape(route)}"}} {values["escalation_rate"]}')
+    lines.append("# HELP langchain_cascade_saved_seconds Estimated latency saved versus always using the last tier.")
+    lines.append("# TYPE langchain_cascade_saved_seconds gauge")
+    for route, values in stats.items():
+        lines.append(f'langchain_cascade_saved_seconds{{route="{_escape(route)}"}} {values["saved_seconds"]}')
+    return lines
+
+def _classify_chain(name: str) -> str:
+    """根据运行名称判断链路阶段"""
+    if "Prompt" in name:
+        return "prompt"
+    if "Parser" in name:
+        return "parser"
+    if name == "AgentExecutor":
+        return "agent"
+    return "chain"
+
+def _token_usage(response: LLMResult) -> Tuple[Optional[int], Optional[int]]:
+    """从模型响应中读取输入/输出token数，兼容OpenAI、usage_metadata和Ollama的字段"""
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    if usage.get("prompt_tokens") is not None:
+        return usage.get("prompt_tokens"), usage.get("completion_tokens")
+    for generations in response.generations:
+        for generation in generations:
+            metadata = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if metadata:
+                return metadata.get("input_tokens"), metadata.get("output_tokens")
+            info = generation.generation_info or {}
+            if info.get("prompt_eval_count") is not None:
+                return info.get("prompt_eval_count"), info.get("eval_count")
+    return None, None
+
+def _router_attributes(response: LLMResult) -> Dict[str, Any]:
+    """路由模型的请求按实际处理请求的后端记录模型和提供商"""
+    for generations in response.generations:
+        for generation in generations:
+            metadata = getattr(getattr(generation, "message", None), "response_metadata", None) or {}
+            if metadata.get("router_backend"):
+                return {
+                    "backend": metadata["router_backend"],
+                    "provider": metadata.get("router_provider", ""),
+                    "model": metadata.get("router_model") or "unknown"
+                }
+    return {}
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """
+    把LangChain回调事件转换成span的回调处理器
+
+    通过run_id和parent_run_id还原调用树，流式输出时记录首token时间。
+    """
+
+    def __init__(self, tracer: Tracer):
+        self.tracer = tracer
+        self._runs: Dict[UUID, Span] = {}
+        self._lock = threading.Lock()
+
+    def _start(self, run_id: UUID, parent_run_id: Optional[UUID], name: str, kind: str, **attributes):
+        with self._lock:
+            parent = self._runs.get(parent_run_id) if parent_run_id else None
+        span = self.tracer.start(name, kind, parent=parent, **attributes)
+        with self._lock:
+            self._runs[run_id] = span
+
+    def _end(self, run_id: UUID, error: Optional[BaseException] = None, **attributes):
+        with self._lock:
+            span = self._runs.pop(run_id, None)
+        if span is None:
+            return
+        span.attributes.update(attributes)
+        self.tracer.end(span, error)
+
+    def on_chain_start(self, serialized, inputs, *, run_id, parent_run_id=None, **kwargs):
+        name = kwargs.get("name") or (serialized or {}).get("name") or "chain"
+        self._start(run_id, parent_run_id, name, _classify_chain(name))
+
+    def on_chain_end(self, outputs, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_chain_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, parent_run_id=None, **kwargs):
+        metadata = kwargs.get("metadata") or {}
+        params = kwargs.get("invocation_params") or {}
+        model = metadata.get("ls_model_name") or params.get("model") or params.get("model_name") or "unknown"
+        self._start(
+            run_id,
+            parent_run_id,
+            kwargs.get("name") or (serialized or {}).get("name") or "chat_model",
+            "llm",
+            model=model,
+            provider=metadata.get("ls_provider", ""),
+            messages=sum(len(batch) for batch in messages)
+        )
+
+    def on_llm_start(self, serialized, prompts, *, run_id, parent_run_id=None, **kwargs):
+        self._start(run_id, parent_run_id, kwargs.get("name") or "llm", "llm", prompts=len(prompts))
+
+    def on_llm_new_token(self, token, *, run_id, **kwargs):
+        with self._lock:
+            span = self._runs.get(run_id)
+        if span is not None and "ttft_ms" not in span.attributes:
+            span.attributes["ttft_ms"] = round((time.time_ns() - span.start_ns) / 1e6, 3)
+
+    def on_llm_end(self, response: LLMResult, *, run_id, **kwargs):
+        input_tokens, output_tokens = _token_usage(response)
+        attributes = _router_attributes(response)
+        if input_tokens is not None:
+            attributes["tokens.input"] = input_tokens
+        if output_tokens is not None:
+            attributes["tokens.output"] = output_tokens
+        self._end(run_id, **attributes)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, parent_run_id=None, **kwargs):
+        name = kwargs.get("name") or (serialized or {}).get("name") or "tool"
+        self._start(run_id, parent_run_id, name, "tool")
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+    def on_retriever_start(self, serialized, query, *, run_id, parent_run_id=None, **kwargs):
+        name = kwargs.get("name") or (serialized or {}).get("name") or "retriever"
+        self._start(run_id, parent_run_id, name, "retriever")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end(run_id, documents=len(documents))
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error)
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """提供/metrics端点的HTTP处理器"""
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = get_tracer().render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    在后台线程中启动Prometheus指标端点
+
+    Args:
+        port: 监听端口
+        host: 监听地址
+
+    Returns:
+        ThreadingHTTPServer: HTTP服务器实例
+    """
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+def telemetry_enabled() -> bool:
+    """是否启用了埋点"""
+    return os.getenv("TELEMETRY_ENABLED", "").strip().lower() in ("1", "true", "yes", "on")
+
+def get_tracer() -> Tracer:
+    """
+    获取全局span收集器
+
+    首次调用时根据环境变量创建导出器，并按需启动Prometheus指标端点。
+    """
+    global _tracer
+    with _tracer_lock:
+        if _tracer is None:
+            exporters = []
+            if telemetry_enabled():
+                path = os.getenv("TELEMETRY_PATH", "telemetry/spans.jsonl")
+                if os.getenv("TELEMETRY_EXPORT", "jsonl") == "otlp":
+                    exporters.append(OtlpJsonFileExporter(path))
+                else:
+                    exporters.append(JsonFileExporter(path))
+                port = os.getenv("TELEMETRY_METRICS_PORT")
+                if port:
+                    start_metrics_server(int(port))
+            _tracer = Tracer(exporters)
+        return _tracer
+
+def get_callbacks() -> List[BaseCallbackHandler]:
+    """
+    获取埋点回调处理器列表
+
+    启用埋点时返回处理器，并把它注册到当前上下文，使提示模板、解析器、工具和检索器等
+    所有LangChain运行都能被记录；未启用时返回空列表。
+    """
+    if not telemetry_enabled():
+        return []
+    handler = _handler_var.get()
+    if handler is None:
+        handler = TracingCallbackHandler(get_tracer())
+        _handler_var.set(handler)
+    return [handler]
+
+@contextmanager
+def span(name: str, kind: str = "internal", **attributes) -> Iterator[Optional[Span]]:
+    """记录一段自定义操作；未启用埋点时不做任何事"""
+    if not telemetry_enabled():
+        yield None
+        return
+    with get_tracer().span(name, kind, **attributes) as current:
+        yield current
+
+class _MemoryTracingMixin:
+    """为记忆组件的加载和保存记录span"""
+
+    def load_memory_variables(self, inputs: Dict[str, Any]) -> Dict[str, Any]:
+        with span("memory.load", "memory", memory=type(self).__name__):
+            return super().load_memory_variables(inputs)
+
+    def save_context(self, inputs: Dict[str, Any], outputs: Dict[str, str]) -> None:
+        with span("memory.save", "memory", memory=type(self).__name__):
+            return super().save_context(inputs, outputs)
+
+_traced_memory_classes: Dict[type, type] = {}
+
+def traced_memory(memory_cls: type, **kwargs):
+    """
+    创建带埋点的记忆组件
+
+    Args:
+        memory_cls: 记忆组件类，例如ConversationBufferMemory
+        **kwargs: 传给记忆组件构造函数的参数
+
+    Returns:
+        记忆组件实例；启用埋点时加载和保存都会记录span
+    """
+    if not telemetry_enabled():
+        return memory_cls(**kwargs)
+    if memory_cls not in _traced_memory_classes:
+        _traced_memory_classes[memory_cls] = type(
+            f"Traced{memory_cls.__name__}",
+            (_MemoryTracingMixin, memory_cls),
+            {}
+        )
+    return _traced_memory_classes[memory_cls](**kwargs)
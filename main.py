@@ -9,7 +9,10 @@ import os
 import sys
 import argparse
 from dotenv import load_dotenv
+from examples.accounting import get_usage_report, usage_scope
 from examples.models import get_model_info, ModelType
+from examples.ollama_residency import get_residency_manager, preload_enabled, preload_models
+from examples.telemetry import span
 
 # 加载环境变量
 load_dotenv()
@@ -18,8 +21,37 @@ load_dotenv()
 SELECTED_MODEL_TYPE: ModelType = os.getenv("MODEL_TYPE", "ollama")  # 默认使用Ollama
 SELECTED_MODEL_NAME = os.getenv("MODEL_NAME")  # 默认使用模型类型的默认模型
 
-def check_model_availability():
-    """检查所选模型是否可用"""
+def check_model_availability(interactive: bool = True):
+    """
+    检查所选模型是否可用
+    
+    Args:
+        interactive: 是否在模型名称可能不可用时询问用户，服务模式下只打印警告
+    """
+    # 回放模式不访问任何提供商，只需要录制文件存在
+    cassette_mode = os.getenv("CASSETTE_MODE", "").strip().lower()
+    if cassette_mode in ("replay", "replay_realtime"):
+        cassette_path = os.getenv("CASSETTE_PATH", "cassettes/default.json.gz")
+        if not os.path.exists(cassette_path):
+            print(f"错误: 录制文件不存在: {cassette_path}，请先用CASSETTE_MODE=record录制。")
+            return False
+        print(f"回放模式({cassette_mode})，使用录制文件: {cassette_path}")
+        return True
+    
+    # 路由模式下由熔断器处理不可用的后端，只要配置合法即可
+    router_spec = os.getenv("ROUTER_BACKENDS")
+    if router_spec:
+        from examples.router import parse_router_backends
+        try:
+            backends = parse_router_backends(router_spec)
+        except ValueError as e:
+            print(f"错误: {str(e)}")
+            return False
+        print(f"已启用多后端路由，共{len(backends)}个后端:")
+        for backend in backends:
+            print(f"  - {backend['model_type']}: {backend['model_name']} ({backend['api_base']})")
+        return True
+    
     model_info = get_model_info()
     
     if not model_info[SELECTED_MODEL_TYPE]["available"]:
@@ -34,6 +66,8 @@ def check_model_availability():
     if SELECTED_MODEL_NAME and SELECTED_MODEL_NAME not in model_info[SELECTED_MODEL_TYPE]["models"]:
         print(f"警告: 指定的模型 '{SELECTED_MODEL_NAME}' 可能不可用。")
         print(f"可用的{SELECTED_MODEL_TYPE}模型: {', '.join(model_info[SELECTED_MODEL_TYPE]['models'])}")
+        if not interactive:
+            return True
         confirm = input("是否继续? (y/n): ")
         if confirm.lower() != 'y':
             return False
@@ -42,6 +76,9 @@ def check_model_availability():
 
 def display_model_info():
     """显示当前选择的模型信息"""
+    if os.getenv("ROUTER_BACKENDS"):
+        print("\n当前使用的模型: 多后端路由 (ROUTER_BACKENDS)")
+        return
     print(f"\n当前使用的模型: {SELECTED_MODEL_TYPE}" + 
           (f" ({SELECTED_MODEL_NAME})" if SELECTED_MODEL_NAME else ""))
 
@@ -131,6 +168,12 @@ def select_specific_model(model_type: ModelType):
             if 0 <= idx < len(models):
                 SELECTED_MODEL_NAME = models[idx]
                 print(f"已选择模型: {SELECTED_MODEL_NAME}")
+                if model_type == "ollama" and preload_enabled():
+                    # 切换模型时按内存预算加载新模型
+                    try:
+                        get_residency_manager().ensure_loaded(SELECTED_MODEL_NAME, warmup=True)
+                    except Exception as e:
+                        print(f"警告: 预加载模型失败: {str(e)}")
                 break
             else:
                 print("无效的选择，请重试。")
@@ -145,50 +188,99 @@ def run_example(choice):
         "model_name": SELECTED_MODEL_NAME
     }
     
+    if choice == "5":
+        select_model()
+        return
+    if choice not in ("1", "2", "3", "4"):
+        print("无效的选择，请重试。")
+        return
+    
     try:
-        if choice == "1":
-            print("\n运行聊天模型示例...")
-            from examples import chat_models
-            chat_models.basic_chat_example()
-            chat_models.chat_with_system_message()
-            chat_models.chat_with_prompt_template()
-        elif choice == "2":
-            print("\n运行链示例...")
-            from examples import chains
-            chains.simple_chain_example()
-            chains.sequential_chain_example()
-            chains.json_output_chain_example()
-        elif choice == "3":
-            print("\n运行记忆示例...")
-            from examples import memory
-            memory.conversation_buffer_memory_example()
-            memory.conversation_summary_memory_example()
-        elif choice == "4":
-            print("\n运行代理示例...")
-            from examples import agents
-            agents.basic_agent_example()
-            agents.retrieval_agent_example()
-        elif choice == "5":
-            select_model()
-        else:
-            print("无效的选择，请重试。")
+        # 启用埋点时，整个示例会记录为一个根span，异常也会被记录下来；token用量按示例汇总
+        with span(f"example.{choice}", "example"), usage_scope(example=f"example.{choice}"):
+            if choice == "1":
+                print("\n运行聊天模型示例...")
+                from examples import chat_models
+                chat_models.basic_chat_example()
+                chat_models.chat_with_system_message()
+                chat_models.chat_with_prompt_template()
+            elif choice == "2":
+                print("\n运行链示例...")
+                from examples import chains
+                chains.simple_chain_example()
+                chains.sequential_chain_example()
+                chains.json_output_chain_example()
+                chains.map_reduce_chain_example()
+            elif choice == "3":
+                print("\n运行记忆示例...")
+                from examples import memory
+                memory.conversation_buffer_memory_example()
+                memory.conversation_summary_memory_example()
+            else:
+                print("\n运行代理示例...")
+                from examples import agents
+                agents.basic_agent_example()
+                agents.retrieval_agent_example()
     except Exception as e:
         print(f"运行示例时出错: {str(e)}")
         print("请检查模型配置和网络连接。")
+    
+    display_usage(f"example.{choice}")
+
+def display_usage(example: str):
+    """显示示例的token用量和估算费用"""
+    usage = get_usage_report()["example"].get(example)
+    if not usage:
+        return
+    line = (f"\ntoken用量: {usage['requests']}次请求，输入{usage['input_tokens']}，"
+            f"输出{usage['output_tokens']}，估算费用${usage['cost']:.4f}")
+    if usage["estimated"]:
+        line += f"(其中{usage['estimated']}次请求为本地估算)"
+    if usage["trimmed"] or usage["refused"]:
+        line += f"，超出预算: 裁剪{usage['trimmed']}次，拒绝{usage['refused']}次"
+    print(line)
+
+def run_example_with_profile(choice, args):
+    """运行示例，指定了--profile时在分析器下运行并生成报告"""
+    if not args.profile or choice not in ("1", "2", "3", "4"):
+        run_example(choice)
+        return
+    
+    from examples.profiling import profile_run
+    profile_run(
+        lambda: run_example(choice),
+        args.profile,
+        label=f"example{choice}",
+        output_root=args.profile_dir
+    )
 
 def parse_arguments():
     """解析命令行参数"""
     global SELECTED_MODEL_TYPE, SELECTED_MODEL_NAME
     
     parser = argparse.ArgumentParser(description="LangChain演示项目")
+    parser.add_argument("command", nargs="?", choices=["serve"],
+                        help="serve: 以常驻的异步HTTP/SSE服务方式运行")
+    parser.add_argument("--host", default="127.0.0.1", help="服务模式的监听地址")
+    parser.add_argument("--port", type=int, default=8000, help="服务模式的监听端口")
     parser.add_argument("--model", "-m", choices=["openai", "deepseek", "ollama"], 
                         help="选择模型类型: openai, deepseek, ollama")
     parser.add_argument("--name", "-n", help="指定模型名称")
     parser.add_argument("--example", "-e", type=int, choices=[1, 2, 3, 4],
                         help="直接运行指定示例: 1=聊天模型, 2=链, 3=记忆, 4=代理")
+    parser.add_argument("--profile", "-p", nargs="?", const="cprofile", metavar="PROFILERS",
+                        help="分析示例性能，可选逗号分隔的分析器: cprofile(默认), sampling, tracemalloc")
+    parser.add_argument("--profile-dir", default="profiles", help="性能分析报告的保存目录")
     
     args = parser.parse_args()
     
+    if args.profile:
+        from examples.profiling import parse_profilers
+        try:
+            args.profile = parse_profilers(args.profile)
+        except ValueError as e:
+            parser.error(str(e))
+    
     if args.model:
         SELECTED_MODEL_TYPE = args.model
     
@@ -205,12 +297,25 @@ def main():
     args = parse_arguments()
     
     # 检查模型可用性
-    if not check_model_availability():
+    if not check_model_availability(interactive=args.command != "serve"):
+        return
+    
+    # 预加载Ollama模型，避免第一次请求承担模型加载时间
+    if SELECTED_MODEL_TYPE == "ollama" and not os.getenv("ROUTER_BACKENDS") and preload_enabled():
+        preload_models(SELECTED_MODEL_NAME)
+    
+    # 服务模式：模型和流水线只初始化一次，供所有请求共享
+    if args.command == "serve":
+        from examples.server import serve
+        serve(args.host, args.port, {
+            "model_type": SELECTED_MODEL_TYPE,
+            "model_name": SELECTED_MODEL_NAME
+        })
         return
     
     # 如果指定了示例，直接运行
     if args.example:
-        run_example(str(args.example))
+        run_example_with_profile(str(args.example), args)
         return
     
     # 交互式菜单
@@ -222,7 +327,7 @@ def main():
             print("\n感谢使用LangChain演示项目，再见!")
             break
         
-        run_example(choice)
+        run_example_with_profile(choice, args)
         
         input("\n按Enter键继续...")
 